@@ -1,13 +1,19 @@
+import asyncio
 import json
+import math
 import os
-from copy import deepcopy
+import re
+import threading
+from functools import lru_cache
 
 import numpy as np
-import openai
 
+import cache
 import config
-
-openai.api_key = config.OPENAI_KEY
+import lexical
+import providers
+from chunker import count_tokens
+from coalescer import AsyncCoalescer, Coalescer
 
 # if prompts.json not present, raise error
 if not os.path.exists(f"prompts.json"):
@@ -20,6 +26,148 @@ with open("prompts.json", "r") as f:
 
 prompt_list = prompts["prompts"]
 
+# tokens of the blank line between two sources
+SEPARATOR_TOKENS = count_tokens("\n\n")
+
+# a substitution slot in a prompt, e.g. [[[QUERY]]]
+SLOT = re.compile(r"\[\[\[(.*?)\]\]\]")
+
+
+class Template:
+    """
+    The content of a prompt message, split at its [[[KEY]]] slots into the literal text
+    between them.
+    """
+
+    __slots__ = ("literals", "slots")
+
+    def __init__(self, content: str):
+        parts = SLOT.split(content)
+
+        self.literals = tuple(parts[0::2])
+        self.slots = tuple(parts[1::2])
+
+    def render(self, substitutions: dict) -> str:
+        if not self.slots:
+            return self.literals[0]
+
+        parts = [self.literals[0]]
+
+        for slot, literal in zip(self.slots, self.literals[1:]):
+            # slots without a substitution are left as they are
+            parts.append(substitutions.get(slot, "[[[" + slot + "]]]"))
+            parts.append(literal)
+
+        return "".join(parts)
+
+
+class CompiledPrompt:
+    """
+    A prompt from prompts.json with each message compiled into a Template.
+
+    `keys` are the substitutions the prompt accepts: those declared in prompts.json and the
+    slots found in its messages.
+    """
+
+    def __init__(self, prompt: dict):
+        self.messages = tuple(
+            (message["role"], Template(message["content"]))
+            for message in prompt["prompt"]
+        )
+        self.keys = frozenset(prompt.get("substitutions", [])).union(
+            *(template.slots for _, template in self.messages)
+        )
+
+    def render(self, substitutions: dict, last: Template = None) -> list:
+        """
+        Return the prompt's messages with substitutions filled in; if given, `last`
+        replaces the content of the last message.
+        """
+        keys = self.keys if last is None else self.keys.union(last.slots)
+        unknown = substitutions.keys() - keys
+
+        if unknown:
+            raise ValueError(
+                f"Unknown substitutions {sorted(unknown)}; the prompt accepts {sorted(keys)}."
+            )
+
+        messages = [
+            {"role": role, "content": template.render(substitutions)}
+            for role, template in self.messages
+        ]
+
+        if last is not None:
+            messages[-1]["content"] = last.render(substitutions)
+
+        return messages
+
+
+# every prompt is compiled once, when the module is loaded
+compiled_prompts = {
+    prompt_id: CompiledPrompt(prompt) for prompt_id, prompt in prompt_list.items()
+}
+
+
+@lru_cache(maxsize=32)
+def compile_template(content: str) -> Template:
+    return Template(content)
+
+
+query_cache = cache.QueryEmbeddingCache()
+
+
+def embed_batch(queries):
+    """
+    Embed several (text, timeout) at once. The request waits as long as the longest timeout,
+    or without one if any query has none.
+    """
+    timeouts = [timeout for _, timeout in queries]
+
+    return providers.provider.embed(
+        [text for text, _ in queries],
+        timeout=None if None in timeouts else max(timeouts),
+    )
+
+
+async def aembed_batch(texts):
+    return await providers.provider.aembed(texts)
+
+
+def search_batch(searches):
+    """
+    Search for several (vector_index, embedded_query, k) at once, with one search per index
+    and k. Returns the ids found for each.
+    """
+    groups = {}
+
+    for i, (vector_index, _, k) in enumerate(searches):
+        groups.setdefault((id(vector_index), k), []).append(i)
+
+    results = [None] * len(searches)
+
+    for (_, k), positions in groups.items():
+        vector_index = searches[positions[0]][0]
+        queries = np.array([searches[i][1] for i in positions], dtype="float32")
+
+        D, I = vector_index.search(queries.reshape(len(positions), 1536), k)
+
+        for i, ids in zip(positions, I):
+            results[i] = ids
+
+    return results
+
+
+# concurrent requests embed and search their queries together
+embed_coalescer = Coalescer(
+    embed_batch, config.QUERY_BATCH_WINDOW_SECONDS, config.QUERY_BATCH_SIZE
+)
+async_embed_coalescer = AsyncCoalescer(
+    aembed_batch, config.QUERY_BATCH_WINDOW_SECONDS, config.QUERY_BATCH_SIZE
+)
+search_coalescer = Coalescer(
+    search_batch, config.QUERY_BATCH_WINDOW_SECONDS, config.QUERY_BATCH_SIZE
+)
+
 
 class Prompt:
     def __init__(self, prompt_id=prompts["latest_id"]):
@@ -28,6 +176,10 @@ class Prompt:
         self.date_created = prompt_list[self.prompt_id]["date"]
         self.index_id = prompt_list[self.prompt_id]["index_id"]
         self.index_name = prompt_list[self.prompt_id]["index_name"]
+        # running average of the tokens a chunk takes up in a prompt, to choose k, updated
+        # once per query
+        self.mean_chunk_tokens = config.CHUNK_MAX_TOKENS / 2
+        self.lock = threading.Lock()
 
     def __repr__(self):
         print(f"Prompt ID: {self.prompt_id}")
@@ -39,89 +191,198 @@ class Prompt:
     def raw_prompt(self):
         return prompt_list[self.prompt_id]["prompt"]
 
+    def render(self, substitutions={}, prompt_text=""):
+        """
+        Return the messages of the prompt with substitutions filled in, as new dicts.
+
+        prompt_text, if given, replaces the content of the last message. Substitutions
+        the prompt does not accept raise a ValueError.
+        """
+        last = compile_template(prompt_text) if prompt_text != "" else None
+
+        return compiled_prompts[self.prompt_id].render(substitutions, last)
+
     def execute(self, substitutions={}, prompt_text="", temperature=None):
-        new_prompt = deepcopy(prompt_list[self.prompt_id])
-
-        if prompt_text != "":
-            new_prompt["prompt"][-1]["content"] = prompt_text
-
-        for message in new_prompt["prompt"]:
-            for key in substitutions:
-                if key in message["content"]:
-                    message["content"] = message["content"].replace(
-                        f"[[[{key}]]]", substitutions[key]
-                    )
-
-        if temperature is not None:
-            return openai.Completion.create(
-                model="gpt-3.5-turbo",
-                messages=new_prompt["prompt"],
-            )["choices"][0]["message"]["content"]
-
-        print(new_prompt["prompt"])
-
-        return openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=new_prompt["prompt"],
-        )["choices"][0]["message"]["content"]
-
-    def get_facts_and_knn(self, query, vector_index, schema, facts):
-        embedded_query = openai.Embedding.create(
-            input=query, model="text-embedding-ada-002"
-        )
+        messages = self.render(substitutions, prompt_text)
 
-        D, I = vector_index.search(
-            np.array([embedded_query["data"][0]["embedding"]]).reshape(1, 1536), 25
-        )
+        return providers.provider.chat(messages, temperature=temperature)
 
-        knn = []
+    def execute_stream(self, substitutions={}, prompt_text="", temperature=None):
+        """
+        Like execute, but yield the completion piece by piece as it is generated.
+        """
+        messages = self.render(substitutions, prompt_text)
 
-        for i in I[0]:
-            knn.append(schema[i]["text"])
+        return providers.provider.chat_stream(messages, temperature=temperature)
 
-        content_sources = [
-            schema[i].get("url", None) for i in I[0] if schema[i].get("url")
-        ]
+    async def aexecute(self, substitutions={}, prompt_text="", temperature=None):
+        messages = self.render(substitutions, prompt_text)
 
-        if len(content_sources) > 0:
-            titles = [schema[i].get("title", schema[i]["url"]) for i in I[0]]
-            dates = [schema[i].get("date", "") for i in I[0]]
+        return await providers.provider.achat(messages, temperature=temperature)
 
-            # create text that looks like this
-            # [fact] (Source: [source])
+    def aexecute_stream(self, substitutions={}, prompt_text="", temperature=None):
+        messages = self.render(substitutions, prompt_text)
 
-            facts_and_sources = []
+        return providers.provider.achat_stream(messages, temperature=temperature)
 
-            for fact in facts:
-                facts_and_sources.append(fact + " (Source: " + config.FACT_SOURCE + ")")
+    def embed_query(self, query, timeout=None):
+        """
+        Return the embedding of a query. If the provider takes longer than timeout seconds,
+        raise a ProviderError.
+        """
+        embedded_query = query_cache.get(query, providers.EMBEDDING_CACHE_NAME)
 
-            skipped = []
+        if embedded_query is None:
+            embedded_query = embed_coalescer((query, timeout))
+            query_cache.put(query, providers.EMBEDDING_CACHE_NAME, embedded_query)
 
-            for i in range(len(knn)):
-                facts_and_sources.append(
-                    knn[i]
-                    + ' (Source: <a href="'
-                    + content_sources[i]
-                    + '">'
-                    + titles[i]
-                    + "</a>, "
-                    + dates[i]
-                    + ")"
+        return embedded_query
+
+    async def aembed_query(self, query):
+        # the cache may go to SQLite, so it is used from a thread
+        embedded_query = await asyncio.to_thread(
+            query_cache.get, query, providers.EMBEDDING_CACHE_NAME
+        )
+
+        if embedded_query is None:
+            embedded_query = await async_embed_coalescer(query)
+            await asyncio.to_thread(
+                query_cache.put, query, providers.EMBEDDING_CACHE_NAME, embedded_query
+            )
+
+        return embedded_query
+
+    def search(self, embedded_query, vector_index, schema, k=25):
+        """
+        Return the rows of the chunks nearest to a query embedding, nearest first.
+        """
+        ids = search_coalescer((vector_index, embedded_query, k))
+
+        # FAISS pads results with -1 when it finds fewer than k neighbours, and indices
+        # that cannot remove vectors still return deleted chunks until they are compacted
+        return schema.live(ids)
+
+    def retrieve(
+        self, query, embedded_query, vector_index, lexical_index, schema, k, mode
+    ):
+        """
+        Return the rows of up to k chunks for a query, best first, ranked by embedding
+        similarity ("vector"), BM25 ("lexical") or both fused ("hybrid").
+        """
+        if mode == "vector":
+            return self.search(embedded_query, vector_index, schema, k)
+
+        rankings = [lexical_index.search(query, k)]
+
+        if mode == "hybrid":
+            rankings.insert(0, search_coalescer((vector_index, embedded_query, k)))
+
+        # a chunk can rank in both, so fuse more than k to still fill k live chunks
+        rows = schema.live(lexical.fuse(rankings, 2 * k))
+
+        return rows[:k]
+
+    def retrieval_k(self, budget):
+        """
+        Choose how many chunks to retrieve: enough to fill the budget with chunks of the
+        average length seen so far, with some to spare for chunks that do not fit.
+        """
+        k = 2 * math.ceil(budget / self.mean_chunk_tokens)
+
+        return max(config.RETRIEVAL_K_MIN, min(config.RETRIEVAL_K_MAX, k))
+
+    def get_facts_and_knn(
+        self,
+        query,
+        vector_index,
+        schema,
+        facts,
+        embedded_query=None,
+        lexical_index=None,
+        mode=config.RETRIEVAL_MODE,
+    ):
+        """
+        Retrieve the chunks most relevant to a query and format them as the prompt's sources.
+
+        Facts come first, then whole chunks in order of relevance while they fit in
+        PROMPT_SOURCES_TOKENS; chunks that would not fit are left out. knn and references
+        only list the chunks that were included.
+
+        Pass embedded_query if the query was already embedded. mode is one of "vector",
+        "lexical" and "hybrid" (see config.RETRIEVAL_MODE); without a lexical_index,
+        "hybrid" searches the vector index alone.
+        """
+        if lexical_index is None:
+            if mode == "lexical":
+                raise ValueError("This index has no lexical index to search.")
+
+            mode = "vector"
+
+        if embedded_query is None and mode != "lexical":
+            embedded_query = self.embed_query(query)
+
+        budget = config.PROMPT_SOURCES_TOKENS
+
+        lines = [fact + " (Source: " + config.FACT_SOURCE + ")" for fact in facts]
+        budget -= sum(count_tokens(line) + SEPARATOR_TOKENS for line in lines)
+
+        k = self.retrieval_k(budget)
+        rows = self.retrieve(
+            query, embedded_query, vector_index, lexical_index, schema, k, mode
+        )
+
+        while True:
+            included = []
+            remaining = budget
+
+            # counted when the chunks were ingested
+            line_tokens = [
+                tokens + SEPARATOR_TOKENS for tokens in schema.line_tokens(rows)
+            ]
+
+            for row, tokens in zip(rows, line_tokens):
+                if tokens <= remaining:
+                    included.append(row)
+                    remaining -= tokens
+
+            # search again with a larger k only if another chunk would likely have fit
+            if (
+                len(rows) < k
+                or k >= config.RETRIEVAL_K_MAX
+                or remaining < self.mean_chunk_tokens
+            ):
+                break
+
+            k = min(config.RETRIEVAL_K_MAX, 2 * k)
+            rows = self.retrieve(
+                query, embedded_query, vector_index, lexical_index, schema, k, mode
+            )
+
+        # from the rows of the last search, which had the largest k
+        if line_tokens:
+            with self.lock:
+                self.mean_chunk_tokens = 0.9 * self.mean_chunk_tokens + 0.1 * (
+                    sum(line_tokens) / len(line_tokens)
                 )
 
-            facts_and_sources_text = "\n\n".join(facts_and_sources)
-            # cut off at 2000 words
-            facts_and_sources_text = " ".join(facts_and_sources_text.split(" ")[:300])
+        documents = schema.fetch(included)
 
-            references = [
-                {"url": content_sources[i], "title": titles[i]}
-                for i in range(len(knn))
-                if i not in skipped
+        # tokens only merge across the separators, so the text is at most the sum of the
+        # lines' tokens
+        text = "\n\n".join(
+            lines
+            + [
+                document["text"] + citation
+                for document, citation in zip(documents, schema.citations(included))
             ]
-        else:
-            facts_and_sources_text = "\n\n".join([schema[i]["text"] for i in I[0]])
-            skipped = []
+        )
+
+        knn = [document["text"] for document in documents]
 
-            references = []
+        references = [
+            {"url": document["url"], "title": document.get("title", document["url"])}
+            for document in documents
+            if document.get("url")
+        ]
 
-        return facts_and_sources_text, knn, references
+        return text, knn, references
@@ -0,0 +1,210 @@
+"""
+What /query and /query/stream do between their calls to the network, shared by the Flask
+app in web.py and the async app in asgi.py: cleaning a query, looking up cached answers,
+retrieving sources, building and caching answers, and the events of a streamed answer.
+
+Moderation, embedding, completions and saving answers are left to each app, which does
+them with its own kind of I/O.
+"""
+import datetime
+import json
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cache
+import config
+from generations import LiveIndex
+from PromptManager import Prompt
+
+prompt_data = Prompt()
+prompt_id = prompt_data.prompt_id
+
+# follows the generations and checkpoints published by ingest.py
+live_index = LiveIndex(prompt_data.index_id, prompt_data.index_name)
+
+answer_cache = cache.SemanticAnswerCache()
+
+# runs moderation alongside the rest of /query, and searches for the async app
+query_executor = ThreadPoolExecutor(max_workers=config.QUERY_WORKERS)
+
+CITATION = r"<a href=\"(.*?)\">(.*?)</a>"
+
+# the answer to a query flagged by moderation, which is not saved
+REFUSAL = {
+    "response": "Sorry. I can't help you with that.",
+    "references": [],
+    "knn": [],
+}
+
+
+def clean_query(query: str) -> str:
+    # remove all punctuation aside from question marks, commas, and full stops
+    query = re.sub(r"[^\w\s\?\.,]", "", query).strip("?")  # .lower()
+
+    # query can be no more than 100 words
+    return " ".join(query.split()[:100])
+
+
+def elapsed_ms(started: float) -> float:
+    return round((time.perf_counter() - started) * 1000, 1)
+
+
+def can_fall_back() -> bool:
+    """
+    Return True if a query that cannot be embedded can be searched lexically instead.
+
+    With a lexical index to fall back on, a slow embedding is given up on; without one,
+    the query waits for it.
+    """
+    return live_index.generation.lexical is not None
+
+
+def embedding_failed(error: Exception):
+    # answered from the lexical index alone
+    sys.stdout.write(f"Could not embed query, searching lexically: {error!r}\n")
+    sys.stdout.flush()
+
+
+def cached_answer(embedded_query):
+    """
+    Return the answer to a question close enough to the query that was answered with the
+    same prompt and index content, or None.
+    """
+    if embedded_query is None:
+        return None
+
+    return answer_cache.get(embedded_query, (prompt_id, live_index.generation.version))
+
+
+def retrieval_mode(embedded_query, generation) -> str:
+    """
+    Search lexically when the query could not be embedded. A generation swapped in without
+    a lexical index embeds the query again while it is searched instead.
+    """
+    if embedded_query is None and generation.lexical is not None:
+        return "lexical"
+
+    return config.RETRIEVAL_MODE
+
+
+def retrieve(query: str, embedded_query) -> dict:
+    """
+    Search the live index for a query, returning the context its completion is generated
+    from: the substitutions for the prompt and what the answer is built and cached from.
+    """
+    current_date = datetime.datetime.now().strftime("%Y-%m-%d")
+
+    facts = []
+
+    # the generation is only held while it is searched, so a swap can free it sooner
+    with live_index.acquire() as generation:
+        version = generation.version
+        facts_and_sources_text, knn, references = prompt_data.get_facts_and_knn(
+            query,
+            generation.vector_index,
+            generation.schema,
+            facts,
+            embedded_query,
+            generation.lexical,
+            retrieval_mode(embedded_query, generation),
+        )
+
+    return {
+        "substitutions": {
+            "CURRENT_DATE": current_date,
+            "FACTS": "\n".join(facts),
+            "SOURCES": facts_and_sources_text,
+            "QUERY": query,
+        },
+        "embedded_query": embedded_query,
+        "version": version,
+        "knn": knn,
+        "references": references,
+    }
+
+
+def extract_citations(response: str) -> list:
+    # get all inline citations
+    citations = re.findall(CITATION, response)
+
+    return [{"url": c[0], "title": c[1]} for c in citations]
+
+
+def build_answer(response: str, context: dict) -> dict:
+    return {
+        "response": response,
+        "knn": context["knn"],
+        "references": {
+            "inline": extract_citations(response),
+            "sources": context["references"],
+        },
+    }
+
+
+def cache_answer(answer: dict, context: dict):
+    if context["embedded_query"] is not None:
+        answer_cache.put(
+            context["embedded_query"], (prompt_id, context["version"]), answer
+        )
+
+
+class CitationStream:
+    """
+    Find inline citations in a completion as it streams in, each as soon as its closing
+    </a> arrives.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.position = 0
+
+    def feed(self, text: str) -> list:
+        self.text += text
+
+        citations = []
+
+        for match in re.compile(CITATION).finditer(self.text, self.position):
+            citations.append({"url": match.group(1), "title": match.group(2)})
+            self.position = match.end()
+
+        return citations
+
+
+def server_sent_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def references_event(knn: list, sources: list) -> str:
+    return server_sent_event("references", {"knn": knn, "sources": sources})
+
+
+def token_events(text: str, citations: CitationStream) -> list:
+    """
+    Return the events of a piece of a streamed completion: the piece, then the citations
+    it completes.
+    """
+    return [server_sent_event("token", {"text": text})] + [
+        server_sent_event("citation", citation) for citation in citations.feed(text)
+    ]
+
+
+def answered_events(answer: dict) -> list:
+    """
+    Return the events of an answer that needed no completion, up to "done".
+    """
+    references = answer["references"] or {"inline": [], "sources": []}
+
+    return [
+        references_event(answer["knn"], references["sources"]),
+        server_sent_event("token", {"text": answer["response"]}),
+    ] + [server_sent_event("citation", citation) for citation in references["inline"]]
+
+
+def done_event(identifier: str, answer: dict, timings: dict) -> str:
+    references = answer["references"] or {"inline": []}
+
+    return server_sent_event(
+        "done", {"id": identifier, "inline": references["inline"], "timings": timings}
+    )
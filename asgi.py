@@ -0,0 +1,341 @@
+"""
+Async serving mode for the web app.
+
+/query, /query/stream, /index and /feedback are served by an async Quart app. These calls
+to OpenAI share a pool of keep-alive connections, and these requests share a pool of database
+connections, so a request waiting on the network does not hold a thread. Every other route is
+passed through to the Flask app in web.py.
+
+The passthrough runs Flask requests on a pool of WSGI_WORKERS threads, and the answer
+and query embedding caches, which take locks and may read SQLite, are used from threads
+too, so nothing blocks the event loop.
+
+Run it with an ASGI server, e.g. `uvicorn asgi:app`.
+"""
+import asyncio
+import datetime
+import time
+import uuid
+
+from a2wsgi import WSGIMiddleware
+from quart import Quart, Response, jsonify, request, session
+
+import config
+import providers
+import web
+from answering import (REFUSAL, CitationStream, answered_events, build_answer,
+                       cache_answer, cached_answer, can_fall_back, clean_query,
+                       done_event, elapsed_ms, embedding_failed, prompt_data,
+                       prompt_id, query_executor, references_event, retrieve,
+                       token_events)
+from chunkstore import document_key, request_error
+from web import write_pending
+
+quart_app = Quart(__name__)
+# the session cookie is shared with the Flask app
+quart_app.secret_key = web.app.secret_key
+
+# routes served by quart_app; everything else goes to web.app
+ASYNC_PATHS = {"/query", "/query/stream", "/index", "/feedback"}
+
+db_pool = None
+
+
+@quart_app.before_serving
+async def open_pools():
+    global db_pool
+
+    if config.DB_TYPE == "postgres":
+        import aiopg
+
+        db_pool = await aiopg.create_pool(
+            host=config.DB_HOST,
+            database=config.DB_NAME,
+            user=config.DB_USER,
+            password=config.DB_PASS,
+            maxsize=config.DB_POOL_SIZE,
+        )
+    if config.DB_TYPE == "mysql":
+        import aiomysql
+
+        db_pool = await aiomysql.create_pool(
+            host=config.DB_HOST,
+            db=config.DB_NAME,
+            user=config.DB_USER,
+            password=config.DB_PASS,
+            maxsize=config.DB_POOL_SIZE,
+            autocommit=True,
+        )
+
+
+@quart_app.after_serving
+async def close_pools():
+    if db_pool is not None:
+        db_pool.close()
+        await db_pool.wait_closed()
+
+    await providers.provider.aclose()
+
+
+async def execute(query: str, parameters: tuple):
+    async with db_pool.acquire() as connection:
+        async with connection.cursor() as cursor:
+            await cursor.execute(query, parameters)
+
+
+async def save_answer(response: str, query: str, username) -> str:
+    """
+    Save a response and its original question, returning the id of the answer.
+    """
+    if db_pool is None:
+        return ""
+
+    identifier = str(uuid.uuid4())
+
+    date = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    await execute(
+        "INSERT INTO answers (prompt, question, id, prompt_id, date, username, status) VALUES (%s, %s, %s, %s, %s, %s, %s)",
+        (response, query, identifier, prompt_id, date, username, "0"),
+    )
+
+    return identifier
+
+
+async def timed(timings: dict, stage: str, awaitable):
+    """
+    Await awaitable, recording how long it took in timings[stage + "_ms"].
+    """
+    start = time.perf_counter()
+
+    try:
+        return await awaitable
+    finally:
+        timings[stage + "_ms"] = round((time.perf_counter() - start) * 1000, 1)
+
+
+async def prompt_is_safe(prompt: str) -> bool:
+    results = await providers.provider.amoderate(prompt)
+
+    # the prompt is not safe if any category was flagged
+    return not results["flagged"]
+
+
+async def prepare_query(query: str, timings: dict):
+    """
+    Like web.prepare_query, without blocking the event loop.
+    """
+    # timed on its own, so a moderation left running when the query fails does not write
+    # to timings after they are sent
+    moderation_timings = {}
+    moderation = asyncio.ensure_future(
+        timed(moderation_timings, "moderation", prompt_is_safe(query))
+    )
+
+    fallback = can_fall_back()
+    embedding = prompt_data.aembed_query(query)
+
+    if fallback:
+        # shielded, so an embedding that arrives too late still fills the cache
+        embedding = asyncio.wait_for(
+            asyncio.shield(embedding), config.QUERY_EMBEDDING_TIMEOUT_SECONDS
+        )
+
+    try:
+        embedded_query = await timed(timings, "embedding", embedding)
+    except (asyncio.TimeoutError, providers.ProviderError) as e:
+        if not fallback:
+            raise
+
+        embedding_failed(e)
+        embedded_query = None
+
+    # the answer cache takes a lock, so it is searched from a thread; a question close to
+    # an earlier one is still moderated before it gets its answer
+    cached = await asyncio.to_thread(cached_answer, embedded_query)
+
+    def search():
+        # searching is CPU bound, so it runs on the thread pool
+        return asyncio.get_running_loop().run_in_executor(
+            query_executor, retrieve, query, embedded_query
+        )
+
+    if cached is None and config.RETRIEVE_DURING_MODERATION:
+        context = await timed(timings, "retrieval", search())
+
+    safe = await timed(timings, "moderation_wait", moderation)
+    timings.update(moderation_timings)
+
+    if not safe:
+        return REFUSAL, None
+
+    if cached is not None:
+        return cached, None
+
+    if not config.RETRIEVE_DURING_MODERATION:
+        context = await timed(timings, "retrieval", search())
+
+    return None, context
+
+
+async def finish_answer(query: str, username, response: str, context: dict) -> dict:
+    answer = build_answer(response, context)
+    await asyncio.to_thread(cache_answer, answer, context)
+
+    return {**answer, "id": await save_answer(response, query, username)}
+
+
+@quart_app.route("/query", methods=["POST"])
+async def query():
+    query = clean_query((await request.form)["query"])
+    username = session.get("me")
+
+    started = time.perf_counter()
+    timings = {}
+
+    answer, context = await prepare_query(query, timings)
+
+    if answer is None:
+        response = await timed(
+            timings, "completion", prompt_data.aexecute(context["substitutions"])
+        )
+        answer = await finish_answer(query, username, response, context)
+    elif answer is not REFUSAL:
+        answer = {
+            **answer,
+            "id": await save_answer(answer["response"], query, username),
+        }
+
+    timings["total_ms"] = elapsed_ms(started)
+
+    return jsonify({**answer, "timings": timings})
+
+
+@quart_app.route("/query/stream", methods=["POST"])
+async def query_stream():
+    """
+    Like web.query_stream: the same events, generated without blocking the event loop.
+    """
+    query = clean_query((await request.form)["query"])
+    username = session.get("me")
+
+    started = time.perf_counter()
+    timings = {}
+
+    answer, context = await prepare_query(query, timings)
+
+    async def answered():
+        for event in answered_events(answer):
+            yield event
+
+        identifier = ""
+
+        if answer is not REFUSAL:
+            identifier = await save_answer(answer["response"], query, username)
+
+        timings["total_ms"] = elapsed_ms(started)
+
+        yield done_event(identifier, answer, timings)
+
+    async def generated():
+        yield references_event(context["knn"], context["references"])
+
+        citations = CitationStream()
+        response = []
+
+        completion_started = time.perf_counter()
+
+        async for text in prompt_data.aexecute_stream(context["substitutions"]):
+            if not response:
+                timings["first_token_ms"] = elapsed_ms(started)
+
+            response.append(text)
+
+            for event in token_events(text, citations):
+                yield event
+
+        timings["completion_ms"] = elapsed_ms(completion_started)
+
+        # only written once the whole response has been sent
+        answer = await finish_answer(query, username, "".join(response), context)
+
+        timings["total_ms"] = elapsed_ms(started)
+
+        yield done_event(answer["id"], answer, timings)
+
+    return Response(
+        answered() if answer is not None else generated(),
+        mimetype="text/event-stream",
+        # stops proxies like nginx from buffering the stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@quart_app.route("/index", methods=["POST"])
+async def index_content():
+    key = request.headers.get("Authorization", "").replace("Bearer ", "")
+
+    if key != web.API_KEY:
+        return jsonify({"status": "error", "message": "Invalid API key."}), 401
+
+    data = await request.get_json()
+    error = request_error(data)
+
+    if error is not None:
+        return jsonify({"status": "error", "message": error}), 400
+
+    await asyncio.to_thread(write_pending, data)
+
+    return jsonify({"status": "success"})
+
+
+@quart_app.route("/index", methods=["DELETE"])
+async def delete_content():
+    key = request.headers.get("Authorization", "").replace("Bearer ", "")
+
+    if key != web.API_KEY:
+        return jsonify({"status": "error", "message": "Invalid API key."}), 401
+
+    data = await request.get_json() or {}
+
+    if not isinstance(data, dict) or document_key(data) is None:
+        return (
+            jsonify({"status": "error", "message": "A url or document_id is required."}),
+            400,
+        )
+
+    await asyncio.to_thread(
+        write_pending,
+        {
+            "action": "delete",
+            "document_id": data.get("document_id"),
+            "url": data.get("url"),
+        },
+    )
+
+    return jsonify({"status": "success"})
+
+
+@quart_app.route("/feedback", methods=["POST"])
+async def feedback():
+    form = await request.form
+    feedback = form["feedback"]
+    id = form["id"]
+
+    # if feedback not 1 or -1, return error
+    if id not in ["1", "-1"]:
+        return jsonify({"success": False})
+
+    await execute("UPDATE answers SET feedback = %s WHERE id = %s", (feedback, id))
+
+    return jsonify({"success": True})
+
+
+flask_app = WSGIMiddleware(web.app, workers=config.WSGI_WORKERS)
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan" or scope.get("path") in ASYNC_PATHS:
+        await quart_app(scope, receive, send)
+    else:
+        await flask_app(scope, receive, send)
@@ -0,0 +1,100 @@
+import argparse
+import os
+import timeit
+import tracemalloc
+from contextlib import redirect_stdout
+from copy import deepcopy
+
+from PromptManager import Prompt, prompt_list
+
+# Parse command line arguments
+parser = argparse.ArgumentParser(
+    description="Compare the time and memory of rendering a prompt with compiled templates against deepcopy and str.replace."
+)
+parser.add_argument("--prompt-id", default=None)
+parser.add_argument("--number", type=int, default=2000)
+parser.add_argument("--sources-words", type=int, default=1100)
+args = parser.parse_args()
+
+prompt = Prompt(args.prompt_id) if args.prompt_id else Prompt()
+
+# about as long as the Sources of a real query
+substitutions = {
+    "CURRENT_DATE": "2024-01-01",
+    "FACTS": "",
+    "SOURCES": " ".join(["coffee"] * args.sources_words),
+    "QUERY": "What do you know about coffee",
+}
+
+devnull = open(os.devnull, "w")
+
+
+def legacy_render():
+    """
+    How prompts were rendered before they were compiled, including the print of the prompt.
+    """
+    new_prompt = deepcopy(prompt_list[prompt.prompt_id])
+
+    for message in new_prompt["prompt"]:
+        for key in substitutions:
+            if key in message["content"]:
+                message["content"] = message["content"].replace(
+                    f"[[[{key}]]]", substitutions[key]
+                )
+
+    with redirect_stdout(devnull):
+        print(new_prompt["prompt"])
+
+    return new_prompt["prompt"]
+
+
+def legacy_render_without_print():
+    new_prompt = deepcopy(prompt_list[prompt.prompt_id])
+
+    for message in new_prompt["prompt"]:
+        for key in substitutions:
+            if key in message["content"]:
+                message["content"] = message["content"].replace(
+                    f"[[[{key}]]]", substitutions[key]
+                )
+
+    return new_prompt["prompt"]
+
+
+def compiled_render():
+    return prompt.render(substitutions)
+
+
+assert legacy_render_without_print() == compiled_render()
+
+
+def peak_memory(function) -> int:
+    """
+    Return the peak memory allocated during one call, in bytes.
+    """
+    tracemalloc.start()
+
+    result = function()
+
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    del result
+
+    return peak
+
+
+print(
+    f"Prompt {prompt.prompt_id}: {len(prompt_list[prompt.prompt_id]['prompt'])} messages, {args.number} renders\n"
+)
+print(f"{'path':<28}{'µs/render':>12}{'peak KB':>10}")
+
+for name, function in (
+    ("deepcopy + replace + print", legacy_render),
+    ("deepcopy + replace", legacy_render_without_print),
+    ("compiled", compiled_render),
+):
+    seconds = min(timeit.repeat(function, number=args.number, repeat=3))
+    peak = peak_memory(function)
+
+    print(f"{name:<28}{seconds / args.number * 1e6:>12.1f}{peak / 1024:>10.1f}")
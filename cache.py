@@ -0,0 +1,261 @@
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import faiss
+import numpy as np
+
+import config
+
+
+def normalize_query(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+class LRUCache:
+    """
+    Thread-safe in-memory cache holding up to `max_entries` values, each for up to
+    `ttl_seconds`. The least recently used entry is evicted first.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float = None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is None:
+                return None
+
+            value, stored = entry
+
+            if self.ttl_seconds is not None and time.time() - stored > self.ttl_seconds:
+                del self.entries[key]
+                return None
+
+            self.entries.move_to_end(key)
+
+            return value
+
+    def put(self, key, value, stored: float = None):
+        with self.lock:
+            self.entries[key] = (value, stored or time.time())
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+class QueryEmbeddingCache:
+    """
+    Cache of query embeddings, keyed by model and normalized query text (lowercase, with
+    runs of whitespace collapsed).
+
+    Lookups go to an in-process LRU first. If `path` is set, embeddings are also stored in
+    a SQLite database there, so every web worker shares them and they survive restarts.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = config.QUERY_CACHE_SIZE,
+        ttl_seconds: float = config.QUERY_CACHE_TTL_SECONDS,
+        path: str = config.QUERY_CACHE_PATH,
+    ):
+        self.ttl_seconds = ttl_seconds
+        self.memory = LRUCache(max_entries, ttl_seconds)
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "disk_hits": 0, "misses": 0}
+
+        self.db = None
+
+        if path:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            # lets several processes read while one writes
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS query_embeddings (key TEXT PRIMARY KEY, embedding BLOB, stored REAL)"
+            )
+
+            if ttl_seconds is not None:
+                self.db.execute(
+                    "DELETE FROM query_embeddings WHERE stored < ?",
+                    (time.time() - ttl_seconds,),
+                )
+
+            self.db.commit()
+
+    @staticmethod
+    def key(text: str, model: str) -> str:
+        return model + "\n" + normalize_query(text)
+
+    def count(self, counter: str):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def get(self, text: str, model: str):
+        """
+        Return the cached embedding of a query, or None.
+        """
+        key = self.key(text, model)
+        embedding = self.memory.get(key)
+
+        if embedding is not None:
+            self.count("hits")
+            return embedding
+
+        if self.db is not None:
+            with self.lock:
+                row = self.db.execute(
+                    "SELECT embedding, stored FROM query_embeddings WHERE key = ?", (key,)
+                ).fetchone()
+
+            if row is not None and (
+                self.ttl_seconds is None or time.time() - row[1] <= self.ttl_seconds
+            ):
+                embedding = np.frombuffer(row[0], dtype="float32")
+                self.memory.put(key, embedding, row[1])
+                self.count("disk_hits")
+                return embedding
+
+        self.count("misses")
+
+        return None
+
+    def put(self, text: str, model: str, embedding):
+        key = self.key(text, model)
+        embedding = np.asarray(embedding, dtype="float32")
+        stored = time.time()
+
+        self.memory.put(key, embedding, stored)
+
+        if self.db is not None:
+            with self.lock:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO query_embeddings VALUES (?, ?, ?)",
+                    (key, embedding.tobytes(), stored),
+                )
+                self.db.commit()
+
+    def stats(self) -> dict:
+        with self.lock:
+            stats = dict(self.counters)
+
+        lookups = stats["hits"] + stats["disk_hits"] + stats["misses"]
+        stats["size"] = len(self.memory)
+        stats["hit_rate"] = (stats["hits"] + stats["disk_hits"]) / lookups if lookups else 0
+
+        return stats
+
+
+class SemanticAnswerCache:
+    """
+    Cache of answers to past questions, looked up by the similarity of question embeddings.
+
+    A question whose embedding has a cosine similarity of at least `threshold` with a cached
+    question gets the cached answer. Answers are only valid for one scope, e.g. a prompt id
+    and index generation: looking up or storing under a new scope empties the cache.
+
+    Up to `max_entries` answers are kept, for up to `ttl_seconds` each; the oldest answer is
+    evicted first.
+    """
+
+    def __init__(
+        self,
+        threshold: float = config.ANSWER_CACHE_THRESHOLD,
+        max_entries: int = config.ANSWER_CACHE_SIZE,
+        ttl_seconds: float = config.ANSWER_CACHE_TTL_SECONDS,
+        dimensions: int = 1536,
+    ):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.dimensions = dimensions
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "invalidations": 0}
+        self.scope = None
+        self.clear()
+
+    def clear(self):
+        self.index = faiss.IndexIDMap2(faiss.IndexFlatIP(self.dimensions))
+        # id -> (answer, time stored), oldest first
+        self.answers = OrderedDict()
+        self.next_id = 0
+
+    def set_scope(self, scope):
+        if scope != self.scope:
+            if self.answers:
+                self.counters["invalidations"] += 1
+
+            self.clear()
+            self.scope = scope
+
+    @staticmethod
+    def unit(embedding) -> np.ndarray:
+        vector = np.asarray(embedding, dtype="float32").reshape(1, -1)
+
+        return vector / np.linalg.norm(vector)
+
+    def get(self, embedding, scope):
+        """
+        Return the answer cached for the most similar question in scope, or None.
+        """
+        if self.threshold is None:
+            return None
+
+        with self.lock:
+            self.set_scope(scope)
+
+            answer = None
+
+            if self.index.ntotal:
+                D, I = self.index.search(self.unit(embedding), 1)
+                entry = self.answers.get(int(I[0][0]))
+
+                if (
+                    entry is not None
+                    and D[0][0] >= self.threshold
+                    and (
+                        self.ttl_seconds is None
+                        or time.time() - entry[1] <= self.ttl_seconds
+                    )
+                ):
+                    answer = entry[0]
+
+            self.counters["hits" if answer is not None else "misses"] += 1
+
+            return answer
+
+    def put(self, embedding, scope, answer: dict):
+        if self.threshold is None:
+            return
+
+        with self.lock:
+            self.set_scope(scope)
+
+            self.index.add_with_ids(
+                self.unit(embedding), np.array([self.next_id], dtype=np.int64)
+            )
+            self.answers[self.next_id] = (answer, time.time())
+            self.next_id += 1
+
+            while len(self.answers) > self.max_entries:
+                oldest, _ = self.answers.popitem(last=False)
+                self.index.remove_ids(np.array([oldest], dtype=np.int64))
+
+    def stats(self) -> dict:
+        with self.lock:
+            stats = dict(self.counters)
+            stats["size"] = len(self.answers)
+
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0
+
+        return stats
@@ -0,0 +1,136 @@
+import re
+
+import tiktoken
+
+import config
+
+# tokenizer used by text-embedding-ada-002 and gpt-3.5-turbo
+encoding = tiktoken.get_encoding("cl100k_base")
+
+# a sentence or a line, with the whitespace that follows it
+SEGMENT = re.compile(r"\S.*?(?:[.!?]+[\"'”’)\]]*(?=\s)|\n|$)\s*", re.S)
+WORD = re.compile(r"\S+\s*")
+# markdown (# Heading) and MediaWiki (== Heading ==) headings
+HEADING = re.compile(r"#{1,6}\s|={2,}[^=\n]+={2,}\s*$")
+
+
+def count_tokens(text: str) -> int:
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def split_segments(text: str, max_tokens: int, break_on_paragraphs: bool = False):
+    """
+    Yield (start, end, tokens, boundary) for each sentence or line in text.
+
+    `boundary` is True when a chunk must start at the segment: at headings, and at
+    paragraphs if break_on_paragraphs is set. Segments longer than max_tokens are
+    split between words, and words longer than max_tokens are split by characters.
+    """
+    previous_end = 0
+
+    for match in SEGMENT.finditer(text):
+        start, end = match.span()
+        segment = match.group()
+
+        at_line_start = start == 0 or text[start - 1] == "\n"
+        boundary = at_line_start and bool(HEADING.match(segment))
+
+        if break_on_paragraphs and "\n\n" in text[previous_end:start]:
+            boundary = True
+
+        previous_end = end - (len(segment) - len(segment.rstrip()))
+
+        tokens = count_tokens(segment)
+
+        if tokens <= max_tokens:
+            yield start, end, tokens, boundary
+            continue
+
+        for word in WORD.finditer(segment):
+            word_start = start + word.start()
+            word_tokens = count_tokens(word.group())
+
+            if word_tokens <= max_tokens:
+                yield word_start, start + word.end(), word_tokens, boundary
+                boundary = False
+                continue
+
+            # a character is at most four bytes and a token covers at least one,
+            # so this many characters always fit
+            width = max(max_tokens // 4, 1)
+
+            for piece_start in range(word_start, start + word.end(), width):
+                piece_end = min(piece_start + width, start + word.end())
+
+                yield piece_start, piece_end, count_tokens(
+                    text[piece_start:piece_end]
+                ), boundary
+                boundary = False
+
+
+def chunk_text(
+    text: str,
+    max_tokens: int = config.CHUNK_MAX_TOKENS,
+    overlap_tokens: int = config.CHUNK_OVERLAP_TOKENS,
+    break_on_paragraphs: bool = False,
+) -> list:
+    """
+    Split text into chunks of at most max_tokens tokens in a single pass.
+
+    Chunks end on sentence or line boundaries and always start a new chunk at a heading.
+    When a chunk is closed because it is full, the next chunk repeats up to overlap_tokens
+    tokens of whole sentences from the end of the previous one.
+
+    Returns a list of {"text", "start", "end", "tokens"} dictionaries, where text is
+    text[start:end]. Token counts are summed per sentence, which can slightly overcount
+    but never undercounts.
+    """
+    chunks = []
+    current = []
+    current_tokens = 0
+
+    def close_chunk():
+        start = current[0][0]
+        end = current[-1][1]
+        chunk = text[start:end].rstrip()
+
+        chunks.append(
+            {
+                "text": chunk,
+                "start": start,
+                "end": start + len(chunk),
+                "tokens": current_tokens,
+            }
+        )
+
+    for segment in split_segments(text, max_tokens, break_on_paragraphs):
+        _, _, tokens, boundary = segment
+
+        if current and (boundary or current_tokens + tokens > max_tokens):
+            close_chunk()
+
+            overlap = []
+            overlap_size = 0
+
+            if not boundary:
+                for previous in reversed(current):
+                    if overlap_size + previous[2] > overlap_tokens:
+                        break
+
+                    overlap.insert(0, previous)
+                    overlap_size += previous[2]
+
+                # the overlap has to leave room for the segment that did not fit
+                while overlap and overlap_size + tokens > max_tokens:
+                    overlap_size -= overlap.pop(0)[2]
+
+            current = overlap
+            current_tokens = overlap_size
+
+        current.append(segment)
+        current_tokens += tokens
+
+    if current:
+        close_chunk()
+
+    return chunks
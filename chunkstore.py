@@ -0,0 +1,496 @@
+import json
+import mmap
+import os
+import re
+
+import numpy as np
+
+from chunker import count_tokens
+
+DATE = re.compile(r"(\d{4})-(\d{2})-(\d{2})")
+
+STRING_COLUMNS = ("url", "title", "document_id")
+
+
+def document_key(data: dict):
+    """
+    Return the key a document is replaced or deleted by: its document_id, or else its url.
+    """
+    key = data.get("document_id") or data.get("url")
+
+    return key if isinstance(key, str) else None
+
+
+def request_error(data):
+    """
+    Return why a request for ingest cannot be carried out, or None if it can: a document
+    needs its text as a string, and a deletion a url or document_id.
+    """
+    if not isinstance(data, dict):
+        return "A JSON object is required."
+
+    if data.get("action") == "delete":
+        if document_key(data) is None:
+            return "A url or document_id is required."
+
+        return None
+
+    if not isinstance(data.get("text"), str):
+        return "A text string is required."
+
+    return None
+
+
+def citation(document: dict) -> str:
+    """
+    Return what follows a chunk's text in the Sources of a prompt,
+    " (Source: <a href="[url]">[title]</a>, [date])", or "" for a chunk without a url.
+    """
+    if not document.get("url"):
+        return ""
+
+    return (
+        ' (Source: <a href="'
+        + document["url"]
+        + '">'
+        + document.get("title", document["url"])
+        + "</a>, "
+        + str(document.get("date", ""))
+        + ")"
+    )
+
+
+def read_column(path: str, dtype, rows: int = None) -> np.ndarray:
+    """
+    Memory-map a fixed-width column file, limited to its first `rows` values.
+    """
+    itemsize = np.dtype(dtype).itemsize
+    count = os.path.getsize(path) // itemsize if os.path.exists(path) else 0
+
+    if rows is not None:
+        count = min(count, rows)
+
+    if count == 0:
+        return np.zeros(0, dtype=dtype)
+
+    return np.memmap(path, dtype=dtype, mode="r", shape=(count,))
+
+
+def append_file(path: str, data: bytes):
+    with open(path, "ab") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def truncate_file(path: str, size: int):
+    if os.path.exists(path) and os.path.getsize(path) > size:
+        os.truncate(path, size)
+
+
+class BlobColumn:
+    """
+    Variable-length values stored back to back in <path>.blob, with the end offset of each
+    value in <path>.offsets.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.map()
+
+    def map(self, rows: int = None):
+        self.offsets = read_column(self.path + ".offsets", np.uint64, rows)
+        self.blob = b""
+
+        if len(self.offsets) and int(self.offsets[-1]) > 0:
+            with open(self.path + ".blob", "rb") as f:
+                self.blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def get(self, row: int) -> bytes:
+        start = int(self.offsets[row - 1]) if row > 0 else 0
+
+        return self.blob[start : int(self.offsets[row])]
+
+    def end(self) -> int:
+        return int(self.offsets[-1]) if len(self.offsets) else 0
+
+    def repair(self, rows: int):
+        """
+        Drop values after the first `rows`, including any left half-written by a crash.
+        """
+        self.map(rows)
+        truncate_file(self.path + ".offsets", len(self) * 8)
+        truncate_file(self.path + ".blob", self.end())
+        self.map(rows)
+
+    def append(self, values: list):
+        # the data is synced before the offsets, so no offset points past the data
+        end = self.end()
+        offsets = []
+
+        for value in values:
+            end += len(value)
+            offsets.append(end)
+
+        append_file(self.path + ".blob", b"".join(values))
+        append_file(
+            self.path + ".offsets", np.array(offsets, dtype=np.uint64).tobytes()
+        )
+
+
+class ChunkStore:
+    """
+    Columnar, memory-mapped store for the chunks of an index stage.
+
+    Row n describes vector n of the index. Each row is split into:
+
+    - url, title and document_id: int32 ids into an interned string table (<stage>_strings),
+      -1 if absent.
+    - date: int32 packed as YYYYMMDD, 0 if absent or not a YYYY-MM-DD string.
+    - text: a blob column, only read for the rows that are fetched.
+    - extra: any other metadata as JSON, in a blob column.
+    - citation: the chunk's citation (see citation()), rendered when it is appended, in a
+      blob column.
+    - line_tokens: int32 number of tokens of the chunk's text followed by its citation.
+
+    Every column is memory-mapped, so opening a store reads nothing up front. A row only
+    counts once every column holds it, so readers never see a partially appended row.
+
+    Row numbers are the chunk ids of the index and never change. Deleting a chunk appends
+    its id to <stage>_deleted.i64 instead of rewriting the store.
+    """
+
+    def __init__(self, prefix: str, writable: bool = False):
+        self.prefix = prefix
+        self.writable = writable
+
+        self.text = BlobColumn(prefix + "_text")
+        self.extra = BlobColumn(prefix + "_extra")
+        self.strings = BlobColumn(prefix + "_strings")
+        self.citation = BlobColumn(prefix + "_citation")
+
+        self.map()
+
+        if writable:
+            self.text.repair(len(self))
+            self.extra.repair(len(self))
+            self.strings.repair(len(self.strings))
+
+            if self.has_source_lines:
+                self.citation.repair(len(self))
+
+            for name in STRING_COLUMNS + ("date", "line_tokens"):
+                truncate_file(self.column_path(name), len(self) * 4)
+
+            # stores written before chunks had a document_id get an empty column
+            if not os.path.exists(self.column_path("document_id")):
+                append_file(
+                    self.column_path("document_id"),
+                    np.full(len(self), -1, dtype=np.int32).tobytes(),
+                )
+
+            # stores written before citations were rendered at ingest get them for every row
+            if not self.has_source_lines:
+                self.write_source_lines()
+
+            self.map()
+
+            self.string_ids = {
+                self.strings.get(i).decode("utf-8"): i
+                for i in range(len(self.strings))
+            }
+
+    @staticmethod
+    def files(prefix: str) -> list:
+        return [
+            prefix + suffix
+            for suffix in (
+                "_text.blob",
+                "_text.offsets",
+                "_extra.blob",
+                "_extra.offsets",
+                "_strings.blob",
+                "_strings.offsets",
+                "_url.i32",
+                "_title.i32",
+                "_document_id.i32",
+                "_date.i32",
+                "_deleted.i64",
+                "_citation.blob",
+                "_citation.offsets",
+                "_line_tokens.i32",
+            )
+        ]
+
+    def column_path(self, name: str) -> str:
+        return self.prefix + "_" + name + ".i32"
+
+    def map(self):
+        self.has_source_lines = os.path.exists(
+            self.column_path("line_tokens")
+        ) and os.path.exists(self.citation.path + ".offsets")
+
+        columns = {
+            name: read_column(self.column_path(name), np.int32)
+            for name in STRING_COLUMNS + ("date",)
+            if name != "document_id" or os.path.exists(self.column_path(name))
+        }
+
+        self.text.map()
+        self.extra.map()
+        self.strings.map()
+
+        blobs = [self.text, self.extra]
+
+        if self.has_source_lines:
+            self.citation.map()
+            columns["line_tokens"] = read_column(self.column_path("line_tokens"), np.int32)
+            blobs.append(self.citation)
+
+        self.rows = min(
+            [len(blob) for blob in blobs] + [len(c) for c in columns.values()]
+        )
+
+        if "document_id" not in columns:
+            columns["document_id"] = np.full(self.rows, -1, dtype=np.int32)
+
+        self.columns = {name: column[: self.rows] for name, column in columns.items()}
+        self.decoded_strings = {}
+        self.deleted = set(read_column(self.prefix + "_deleted.i64", np.int64).tolist())
+
+    def __len__(self):
+        return self.rows
+
+    def string(self, string_id: int):
+        if string_id < 0:
+            return None
+
+        if string_id not in self.decoded_strings:
+            value = self.strings.get(string_id).decode("utf-8")
+            self.decoded_strings[string_id] = value
+
+        return self.decoded_strings[string_id]
+
+    def fetch(self, rows: list) -> list:
+        """
+        Return the given rows as dictionaries with the chunk's text and metadata.
+        """
+        documents = []
+
+        for row in rows:
+            document = {"text": self.text.get(row).decode("utf-8")}
+
+            for name in STRING_COLUMNS:
+                value = self.string(int(self.columns[name][row]))
+
+                if value is not None:
+                    document[name] = value
+
+            date = int(self.columns["date"][row])
+
+            if date:
+                document["date"] = (
+                    f"{date // 10000:04d}-{date // 100 % 100:02d}-{date % 100:02d}"
+                )
+
+            extra = self.extra.get(row)
+
+            if extra != b"{}":
+                document.update(json.loads(extra))
+
+            documents.append(document)
+
+        return documents
+
+    def __getitem__(self, row: int) -> dict:
+        if row < 0:
+            row += len(self)
+
+        if not 0 <= row < len(self):
+            raise IndexError("chunk row out of range")
+
+        return self.fetch([row])[0]
+
+    def __iter__(self):
+        """
+        Iterate over the chunks that have not been deleted.
+        """
+        for start in range(0, len(self), 1000):
+            rows = self.live(range(start, min(start + 1000, len(self))))
+
+            yield from self.fetch(rows)
+
+    def citations(self, rows: list) -> list:
+        """
+        Return the citation of each of the given rows.
+        """
+        if not self.has_source_lines:
+            return [citation(document) for document in self.fetch(rows)]
+
+        return [self.citation.get(row).decode("utf-8") for row in rows]
+
+    def line_tokens(self, rows: list) -> list:
+        """
+        Return the number of tokens of each of the given rows' text followed by its citation.
+        """
+        if not self.has_source_lines:
+            return [
+                count_tokens(document["text"] + citation(document))
+                for document in self.fetch(rows)
+            ]
+
+        return self.columns["line_tokens"][rows].tolist()
+
+    def write_source_lines(self):
+        """
+        Render the citation and count the tokens of every row.
+
+        The columns are written under temporary names first, so a crash leaves the store
+        without them rather than with fewer rows.
+        """
+        paths = {
+            "blob": self.citation.path + ".blob",
+            "offsets": self.citation.path + ".offsets",
+            "tokens": self.column_path("line_tokens"),
+        }
+        end = 0
+
+        with open(paths["blob"] + ".tmp", "wb") as blob, open(
+            paths["offsets"] + ".tmp", "wb"
+        ) as offsets, open(paths["tokens"] + ".tmp", "wb") as tokens:
+            for start in range(0, len(self), 1000):
+                documents = self.fetch(range(start, min(start + 1000, len(self))))
+                citations = [citation(document) for document in documents]
+                encoded = [value.encode("utf-8") for value in citations]
+
+                ends = end + np.cumsum([len(value) for value in encoded], dtype=np.uint64)
+                end = int(ends[-1])
+
+                blob.write(b"".join(encoded))
+                offsets.write(ends.astype(np.uint64).tobytes())
+                tokens.write(
+                    np.array(
+                        [
+                            count_tokens(document["text"] + value)
+                            for document, value in zip(documents, citations)
+                        ],
+                        dtype=np.int32,
+                    ).tobytes()
+                )
+
+        # the offsets are replaced last, as the columns only count once they exist
+        for name in ("blob", "tokens", "offsets"):
+            os.replace(paths[name] + ".tmp", paths[name])
+
+    def live(self, rows) -> list:
+        """
+        Return the given rows that hold a chunk which has not been deleted, in order.
+        """
+        return [
+            int(row)
+            for row in rows
+            if 0 <= row < len(self) and int(row) not in self.deleted
+        ]
+
+    def documents(self) -> dict:
+        """
+        Map the key of each document (see document_key) to the rows of its live chunks.
+        """
+        keys = np.where(
+            self.columns["document_id"] >= 0,
+            self.columns["document_id"],
+            self.columns["url"],
+        )
+        rows = np.array(self.live(np.flatnonzero(keys >= 0)), dtype=np.int64)
+
+        documents = {}
+
+        for row, key in zip(rows.tolist(), keys[rows].tolist()):
+            documents.setdefault(self.string(key), []).append(row)
+
+        return documents
+
+    def delete(self, rows: list):
+        if not self.writable:
+            raise ValueError("This chunk store was opened read-only.")
+
+        rows = self.live(rows)
+
+        if not rows:
+            return
+
+        append_file(
+            self.prefix + "_deleted.i64", np.array(rows, dtype=np.int64).tobytes()
+        )
+        self.deleted.update(rows)
+
+    def intern(self, value: str, new_strings: list) -> int:
+        if value not in self.string_ids:
+            self.string_ids[value] = len(self.string_ids)
+            new_strings.append(value.encode("utf-8"))
+
+        return self.string_ids[value]
+
+    def append(self, documents: list):
+        if not self.writable:
+            raise ValueError("This chunk store was opened read-only.")
+
+        if not documents:
+            return
+
+        new_strings = []
+        columns = {name: [] for name in STRING_COLUMNS + ("date", "line_tokens")}
+        texts = []
+        extras = []
+        citations = []
+
+        for document in documents:
+            rendered = citation(document)
+            citations.append(rendered.encode("utf-8"))
+            columns["line_tokens"].append(count_tokens(document["text"] + rendered))
+
+            extra = {k: v for k, v in document.items() if k != "text"}
+
+            for name in STRING_COLUMNS:
+                value = extra.get(name)
+
+                if isinstance(value, str):
+                    columns[name].append(self.intern(value, new_strings))
+                    del extra[name]
+                else:
+                    columns[name].append(-1)
+
+            date = extra.get("date")
+            match = DATE.fullmatch(date) if isinstance(date, str) else None
+            packed = 0
+
+            if match:
+                year, month, day = (int(part) for part in match.groups())
+                packed = year * 10000 + month * 100 + day
+
+            # 0 means "no date", so a 0000-00-00 date stays in extra
+            if packed:
+                del extra["date"]
+
+            columns["date"].append(packed)
+
+            texts.append(document["text"].encode("utf-8"))
+            extras.append(json.dumps(extra).encode("utf-8"))
+
+        # strings and blobs are written before the fixed-width columns that refer to them
+        if new_strings:
+            self.strings.append(new_strings)
+
+        self.text.append(texts)
+        self.extra.append(extras)
+        self.citation.append(citations)
+
+        for name, values in columns.items():
+            append_file(
+                self.column_path(name), np.array(values, dtype=np.int32).tobytes()
+            )
+
+        self.map()
@@ -0,0 +1,146 @@
+import asyncio
+import threading
+
+
+class Batch:
+    def __init__(self):
+        self.items = []
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.results = None
+        self.error = None
+
+
+class Coalescer:
+    """
+    Combine the calls that concurrent threads make within `window_seconds` of each other into
+    one call of `function`, which takes a list of items and returns one result per item.
+
+    The first caller of a batch waits for the window to pass, or for `max_batch` items, then
+    calls `function` for everyone in the batch. With a window of 0, every call goes straight
+    to `function`.
+    """
+
+    def __init__(self, function, window_seconds: float, max_batch: int):
+        self.function = function
+        self.window_seconds = window_seconds
+        self.max_batch = max_batch
+        self.lock = threading.Lock()
+        self.batch = None
+        self.counters = {"calls": 0, "batches": 0}
+
+    def __call__(self, item):
+        if not self.window_seconds:
+            return self.function([item])[0]
+
+        with self.lock:
+            self.counters["calls"] += 1
+
+            batch = self.batch
+            leader = batch is None
+
+            if leader:
+                batch = self.batch = Batch()
+                self.counters["batches"] += 1
+
+            position = len(batch.items)
+            batch.items.append(item)
+
+            if len(batch.items) >= self.max_batch:
+                self.batch = None
+                batch.full.set()
+
+        if leader:
+            batch.full.wait(self.window_seconds)
+
+            with self.lock:
+                if self.batch is batch:
+                    self.batch = None
+
+            try:
+                batch.results = self.function(batch.items)
+            except Exception as e:
+                batch.error = e
+
+            batch.done.set()
+        else:
+            batch.done.wait()
+
+        if batch.error is not None:
+            raise batch.error
+
+        return batch.results[position]
+
+    def stats(self) -> dict:
+        with self.lock:
+            stats = dict(self.counters)
+
+        stats["mean_batch_size"] = (
+            stats["calls"] / stats["batches"] if stats["batches"] else 0
+        )
+
+        return stats
+
+
+class AsyncCoalescer:
+    """
+    Coalescer for coroutines on one event loop: `function` is a coroutine function taking a
+    list of items.
+    """
+
+    def __init__(self, function, window_seconds: float, max_batch: int):
+        self.function = function
+        self.window_seconds = window_seconds
+        self.max_batch = max_batch
+        self.pending = []
+        self.timer = None
+        self.counters = {"calls": 0, "batches": 0}
+
+    async def __call__(self, item):
+        if not self.window_seconds:
+            return (await self.function([item]))[0]
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        self.counters["calls"] += 1
+        self.pending.append((item, future))
+
+        if len(self.pending) >= self.max_batch:
+            self.flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.window_seconds, self.flush)
+
+        return await future
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        batch, self.pending = self.pending, []
+        self.counters["batches"] += 1
+
+        asyncio.ensure_future(self.run(batch))
+
+    async def run(self, batch: list):
+        try:
+            results = await self.function([item for item, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    def stats(self) -> dict:
+        stats = dict(self.counters)
+
+        stats["mean_batch_size"] = (
+            stats["calls"] / stats["batches"] if stats["batches"] else 0
+        )
+
+        return stats
@@ -11,3 +11,138 @@ DB_USER = "root"
 DB_PASS = ""
 
 OPENAI_KEY = ""
+
+# maximum number of chunks and (estimated) tokens sent in one embedding request
+EMBEDDING_BATCH_SIZE = 256
+EMBEDDING_BATCH_TOKENS = 50000
+
+# ingest saves the FAISS index after this many new chunks or seconds, whichever comes first
+INGEST_CHECKPOINT_CHUNKS = 1000
+INGEST_CHECKPOINT_SECONDS = 300
+# schema journal rows written between fsyncs
+SCHEMA_FSYNC_EVERY = 256
+
+# embedding quota shared by all ingest threads
+EMBEDDING_REQUESTS_PER_MINUTE = 3000
+EMBEDDING_TOKENS_PER_MINUTE = 1000000
+INGEST_WORKERS = 8
+
+# embeddings are cached here so rebuilding an index does not re-embed unchanged chunks
+EMBEDDING_CACHE_DIR = "embedding_cache"
+
+# how often `python ingest.py --watch` looks for new documents in pending_indexing/
+INGEST_POLL_SECONDS = 2
+
+# when a round of `python ingest.py --watch` fails, e.g. because the embeddings API is down,
+# it is retried after a delay that doubles with each failure, up to this many seconds
+INGEST_RETRY_MAX_SECONDS = 300
+
+# chunk size and overlap used by ingest, in tokens
+CHUNK_MAX_TOKENS = 500
+CHUNK_OVERLAP_TOKENS = 50
+
+# chunks at least this similar (estimated Jaccard similarity of word 5-grams) to an
+# indexed chunk are not indexed again; set to None to index every chunk
+DEDUP_THRESHOLD = 0.9
+
+# index built by `python ingest.py --new`: "flat", "ivf", "hnsw" or "ivfpq"
+# every type except "flat" is trained on a sample of cached embeddings
+INDEX_TYPE = "flat"
+
+# web.py and eval.py memory-map indices so that worker processes share their pages; flat
+# indices, and the vectors of "hnsw" indices, can only be memory-mapped from this FAISS
+# version on, and are read into each process's memory (with a warning) before it
+FAISS_MMAP_MIN_VERSION = "1.11.0"
+INDEX_NLIST = 1024
+INDEX_NPROBE = 16
+INDEX_HNSW_M = 32
+INDEX_EF_SEARCH = 64
+INDEX_PQ_M = 64
+INDEX_TRAINING_SAMPLES = 100000
+
+# how often `python ingest.py --watch` rebuilds the index without deleted chunks; only
+# needed for index types that cannot remove vectors in place, like "hnsw"
+INDEX_COMPACT_SECONDS = 3600
+
+# how often web.py checks for a newly published index generation or checkpoint
+WEB_RELOAD_POLL_SECONDS = 1
+
+# number of shards of an index built by `python ingest.py --new`, and whether chunks are
+# split over them by document or by site (the host of their url)
+INDEX_SHARDS = 1
+INDEX_SHARD_BY = "document"
+# threads searching the shards of sharded indices in parallel
+SEARCH_WORKERS = 8
+
+# how an index built by `python ingest.py --new` stores vectors: "float32", "float16" or
+# "int8", optionally reduced to INDEX_PCA_DIMS dimensions first (None keeps all 1536);
+# run `python storage_report.py` to compare memory and recall on the current index
+INDEX_STORAGE = "float32"
+INDEX_PCA_DIMS = None
+
+# where embeddings, chat completions and moderation come from: "openai", or "fake" for
+# offline benchmarks and load tests (see providers.FakeProvider)
+PROVIDER = "openai"
+# send OpenAI requests to another server that speaks the API, e.g.
+# "http://localhost:8001/v1" for `python fake_openai_server.py`
+OPENAI_API_BASE = None
+# (median seconds, lognormal sigma) of each call made to the fake provider
+FAKE_PROVIDER_LATENCY = {
+    "embed": (0.2, 0.3),
+    "chat": (1.5, 0.4),
+    "moderate": (0.15, 0.3),
+}
+
+# query embeddings kept by each web worker, and for how long; set QUERY_CACHE_PATH to a
+# SQLite file, e.g. "query_cache.sqlite", to share them between workers and restarts
+QUERY_CACHE_SIZE = 10000
+QUERY_CACHE_TTL_SECONDS = 7 * 24 * 3600
+QUERY_CACHE_PATH = None
+
+# a question at least this similar (cosine similarity of embeddings) to one answered with
+# the same prompt and index checkpoint gets the same answer; None disables the cache
+ANSWER_CACHE_THRESHOLD = 0.97
+ANSWER_CACHE_SIZE = 10000
+ANSWER_CACHE_TTL_SECONDS = 24 * 3600
+
+# threads running moderation requests for /query, next to the request threads
+QUERY_WORKERS = 16
+# search the index while the query is being moderated, instead of after; the results are
+# thrown away if the query is flagged
+RETRIEVE_DURING_MODERATION = True
+
+# connections kept open to the OpenAI API by the async serving mode (asgi.py)
+ASYNC_HTTP_CONNECTIONS = 100
+# database connections shared by async requests
+DB_POOL_SIZE = 20
+# threads serving the routes that asgi.py passes through to the Flask app
+WSGI_WORKERS = 16
+
+# queries that arrive within this many seconds of each other are embedded in one API call
+# and searched in one batch; 0 turns batching off
+QUERY_BATCH_WINDOW_SECONDS = 0.005
+# the most queries embedded or searched in one batch
+QUERY_BATCH_SIZE = 64
+
+# most tokens of facts and retrieved chunks put in the Sources of a prompt; chunks are
+# only included whole
+PROMPT_SOURCES_TOKENS = 1500
+# fewest and most chunks retrieved for a query; in between, k is chosen from the token
+# budget and the average length of retrieved chunks
+RETRIEVAL_K_MIN = 5
+RETRIEVAL_K_MAX = 25
+
+# build a BM25 index of the chunks next to each FAISS index
+LEXICAL_INDEX = True
+# how chunks are retrieved for a query: "vector" (embedding similarity), "lexical" (BM25)
+# or "hybrid" (both, fused with reciprocal rank fusion); indices without a lexical index
+# fall back to "vector"
+RETRIEVAL_MODE = "hybrid"
+# constant of reciprocal rank fusion; larger values weigh lower ranks more evenly
+RRF_K = 60
+# how long the files of lexical segments replaced by a merge are kept, so a web.py that
+# read the list of segments just before the merge can still open them
+LEXICAL_SEGMENT_GRACE_SECONDS = 300
+# queries whose embedding takes longer than this, or fails, are answered from the lexical
+# index alone; None waits for the embedding
+QUERY_EMBEDDING_TIMEOUT_SECONDS = 2
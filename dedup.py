@@ -0,0 +1,227 @@
+import hashlib
+import json
+import os
+import re
+import zlib
+
+import numpy as np
+
+import config
+from chunkstore import document_key
+
+# Mersenne prime used by the MinHash permutations
+PRIME = (1 << 31) - 1
+
+
+def normalize(text: str) -> str:
+    return " ".join(re.sub(r"\W+", " ", text.lower()).split())
+
+
+def choose_bands(num_perm: int, threshold: float) -> tuple:
+    """
+    Pick the (bands, rows) split of a signature whose LSH threshold (1/bands)^(1/rows) is closest to threshold.
+    """
+    options = [
+        (bands, num_perm // bands)
+        for bands in range(1, num_perm + 1)
+        if num_perm % bands == 0
+    ]
+
+    return min(
+        options, key=lambda option: abs((1 / option[0]) ** (1 / option[1]) - threshold)
+    )
+
+
+class Deduplicator:
+    """
+    Detect chunks that are exact or near duplicates of chunks seen before.
+
+    Exact duplicates are found by hashing the normalized text. Near duplicates are found
+    with MinHash signatures over word shingles, bucketed with locality-sensitive hashing.
+    Candidates from the LSH buckets are kept only if their estimated Jaccard similarity is
+    at least `threshold`.
+    """
+
+    def __init__(
+        self,
+        threshold: float = config.DEDUP_THRESHOLD,
+        num_perm: int = 128,
+        shingle_size: int = 5,
+    ):
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        self.bands, self.rows = choose_bands(num_perm, threshold)
+
+        rng = np.random.default_rng(1)
+        self.a = rng.integers(1, PRIME, num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, PRIME, num_perm, dtype=np.uint64)
+
+        # digest of each remembered text -> position of its signature
+        self.hashes = {}
+        self.signatures = []
+        # key of the document each remembered text is in, or None
+        self.owners = []
+        self.buckets = [{} for _ in range(self.bands)]
+        # positions of texts that were forgotten
+        self.forgotten = set()
+
+    @classmethod
+    def from_schema(cls, schema: list, **kwargs):
+        deduplicator = cls(**kwargs)
+
+        for document in schema:
+            deduplicator.seen(document["text"], document_key(document))
+
+        return deduplicator
+
+    def signature(self, words: list) -> np.ndarray:
+        size = self.shingle_size
+
+        shingles = {
+            " ".join(words[i : i + size]) for i in range(max(len(words) - size + 1, 1))
+        }
+
+        values = np.array(
+            [zlib.crc32(shingle.encode("utf-8")) for shingle in shingles],
+            dtype=np.uint64,
+        ) % PRIME
+
+        return (
+            ((np.outer(values, self.a) + self.b) % PRIME).min(axis=0).astype(np.uint32)
+        )
+
+    def seen(self, text: str, owner: str = None) -> bool:
+        """
+        Return True if text duplicates a chunk seen before; otherwise remember it and return False.
+        """
+        return self.duplicate(text, owner) is not None
+
+    def duplicate(self, text: str, owner: str = None):
+        """
+        Return the position of the chunk seen before that text duplicates, whose document
+        is owners[position]; otherwise remember text as part of the document with key owner
+        and return None.
+        """
+        normalized = normalize(text)
+        digest = hashlib.sha1(normalized.encode("utf-8")).digest()
+
+        if digest in self.hashes:
+            return self.hashes[digest]
+
+        signature = self.signature(normalized.split(" "))
+        keys = [
+            signature[band * self.rows : (band + 1) * self.rows].tobytes()
+            for band in range(self.bands)
+        ]
+
+        candidates = set()
+
+        for bucket, key in zip(self.buckets, keys):
+            candidates.update(bucket.get(key, []))
+
+        for candidate in candidates - self.forgotten:
+            if np.mean(self.signatures[candidate] == signature) >= self.threshold:
+                return candidate
+
+        position = len(self.signatures)
+
+        self.hashes[digest] = position
+        self.signatures.append(signature)
+        self.owners.append(owner)
+
+        for bucket, key in zip(self.buckets, keys):
+            bucket.setdefault(key, []).append(position)
+
+        return None
+
+    def remembers(self, text: str) -> bool:
+        """
+        Return True if a chunk with exactly this text, once normalized, is remembered.
+        """
+        return hashlib.sha1(normalize(text).encode("utf-8")).digest() in self.hashes
+
+    def forget(self, text: str):
+        """
+        Stop treating text as seen, e.g. when the chunk holding it is deleted.
+        """
+        digest = hashlib.sha1(normalize(text).encode("utf-8")).digest()
+        position = self.hashes.pop(digest, None)
+
+        if position is not None:
+            self.forgotten.add(position)
+
+
+class Dependents:
+    """
+    The files in indexed_docs/ that dropped chunks as duplicates of another document's,
+    by the key of that document, so they can be indexed again once its chunks are deleted.
+
+    Records are appended to a JSON lines file as files are indexed, and the file is
+    rewritten when records are removed.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        # key of a document -> {file that dropped duplicates of its chunks: key of the file}
+        self.files = {}
+
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # cut short when ingest stopped
+                        continue
+
+                    self.files.setdefault(record["of"], {})[record["file"]] = record["key"]
+
+    def add(self, of: str, file: str, key: str = None):
+        self.files.setdefault(of, {})[file] = key
+
+        with open(self.path, "a") as f:
+            f.write(json.dumps({"of": of, "file": file, "key": key}) + "\n")
+
+    def pop(self, of: str) -> list:
+        """
+        Return the (file, key) of the files that dropped duplicates of the chunks of the
+        document with key of, and forget them.
+        """
+        files = self.files.pop(of, {})
+
+        if files:
+            self.write()
+
+        return sorted(files.items())
+
+    def discard(self, key: str):
+        """
+        Forget the files of the document with this key, when a new version replaces them.
+        """
+        changed = False
+
+        for of in list(self.files):
+            files = {
+                file: file_key
+                for file, file_key in self.files[of].items()
+                if file_key != key
+            }
+
+            if len(files) < len(self.files[of]):
+                changed = True
+
+                if files:
+                    self.files[of] = files
+                else:
+                    del self.files[of]
+
+        if changed:
+            self.write()
+
+    def write(self):
+        with open(self.path + ".tmp", "w") as f:
+            for of, files in self.files.items():
+                for file, key in files.items():
+                    f.write(json.dumps({"of": of, "file": file, "key": key}) + "\n")
+
+        os.replace(self.path + ".tmp", self.path)
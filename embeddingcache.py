@@ -0,0 +1,180 @@
+import fcntl
+import hashlib
+import os
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+import config
+
+KEY_SIZE = 32
+
+
+class EmbeddingCache:
+    """
+    Persistent cache of embeddings keyed by (model, SHA-256 of the text).
+
+    Each model has its own directory under `directory` holding two files:
+
+    - vectors.f32: one float32 row per cached text, read through a memory map.
+    - keys.bin: the 32 byte digest of each row's text, in the same order as the vectors.
+
+    Rows are only ever appended, so the cache can be shared by every index generation.
+
+    Several processes can open the cache at once. Writers take an exclusive lock on the
+    directory's lock file while they repair or append to it, and pick up rows appended by
+    other processes before appending their own. With writable=False, the cache is only read
+    and never repaired.
+    """
+
+    def __init__(
+        self,
+        model: str,
+        dimensions: int = 1536,
+        directory: str = config.EMBEDDING_CACHE_DIR,
+        writable: bool = True,
+    ):
+        self.dimensions = dimensions
+        self.writable = writable
+        self.lock = threading.Lock()
+
+        path = os.path.join(directory, model)
+
+        if writable:
+            os.makedirs(path, exist_ok=True)
+
+        self.vectors_path = os.path.join(path, "vectors.f32")
+        self.keys_path = os.path.join(path, "keys.bin")
+
+        self.count = 0
+        self.rows = {}
+        self.vectors = None
+
+        if not writable:
+            self._read_appended()
+            return
+
+        self.lock_file = open(os.path.join(path, "lock"), "a")
+
+        with self._locked():
+            self._read_appended()
+
+            # a crash between writing a vector and its key leaves the files different
+            # lengths; with the lock held, no other writer is partway through an append
+            for file_path, size in (
+                (self.keys_path, self.count * KEY_SIZE),
+                (self.vectors_path, self.count * dimensions * 4),
+            ):
+                if os.path.exists(file_path) and os.path.getsize(file_path) != size:
+                    os.truncate(file_path, size)
+
+        self.vectors_file = open(self.vectors_path, "ab")
+        self.keys_file = open(self.keys_path, "ab")
+
+    @contextmanager
+    def _locked(self):
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+
+        try:
+            yield
+        finally:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+
+    def _read_appended(self):
+        """
+        Add the rows appended to the files since they were last read, e.g. by another process.
+        """
+        if not os.path.exists(self.keys_path) or not os.path.exists(self.vectors_path):
+            return
+
+        row_size = self.dimensions * 4
+        count = min(
+            os.path.getsize(self.keys_path) // KEY_SIZE,
+            os.path.getsize(self.vectors_path) // row_size,
+        )
+
+        if count <= self.count:
+            return
+
+        with open(self.keys_path, "rb") as f:
+            f.seek(self.count * KEY_SIZE)
+            keys = f.read((count - self.count) * KEY_SIZE)
+
+        for i in range(count - self.count):
+            self.rows.setdefault(keys[i * KEY_SIZE : (i + 1) * KEY_SIZE], self.count + i)
+
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    @staticmethod
+    def key(text: str) -> bytes:
+        return hashlib.sha256(text.encode("utf-8")).digest()
+
+    def _mapped_vectors(self):
+        # remap once rows have been appended since the file was last mapped
+        if self.vectors is None or len(self.vectors) < self.count:
+            self.vectors = np.memmap(
+                self.vectors_path,
+                dtype="float32",
+                mode="r",
+                shape=(self.count, self.dimensions),
+            )
+
+        return self.vectors
+
+    def get_many(self, texts: list) -> list:
+        """
+        Return the cached embedding of each text, or None for texts that are not cached.
+        """
+        with self.lock:
+            rows = [self.rows.get(self.key(text)) for text in texts]
+
+            if all(row is None for row in rows):
+                return rows
+
+            vectors = self._mapped_vectors()
+
+            return [np.array(vectors[row]) if row is not None else None for row in rows]
+
+    def put_many(self, texts: list, embeddings: list):
+        if not self.writable:
+            raise ValueError("This embedding cache was opened read-only.")
+
+        with self.lock, self._locked():
+            self._read_appended()
+
+            vectors = []
+            keys = []
+
+            for text, embedding in zip(texts, embeddings):
+                key = self.key(text)
+
+                if embedding is None or key in self.rows:
+                    continue
+
+                vectors.append(np.asarray(embedding, dtype="float32").tobytes())
+                keys.append(key)
+
+                self.rows[key] = self.count
+                self.count += 1
+
+            # vectors first, so a key is never on disk without its vector
+            self.vectors_file.write(b"".join(vectors))
+            self.vectors_file.flush()
+            self.keys_file.write(b"".join(keys))
+            self.keys_file.flush()
+
+    def sample(self, count: int) -> np.ndarray:
+        """
+        Return up to `count` randomly chosen cached embeddings.
+        """
+        with self.lock:
+            if self.count == 0:
+                return np.zeros((0, self.dimensions), dtype="float32")
+
+            rows = np.random.choice(self.count, min(count, self.count), replace=False)
+
+            return np.array(self._mapped_vectors()[np.sort(rows)])
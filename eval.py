@@ -4,8 +4,7 @@ import json
 import os
 import uuid
 
-import faiss
-
+import indexstore
 from PromptManager import Prompt
 
 # Parse command line arguments
@@ -39,11 +38,13 @@ Sources:
 """
 
 # Load vector index
-vector_index = faiss.read_index(f"indices/{index_number}/{queried_index}_vector_index.bin")
+vector_index = indexstore.load_index(index_number, queried_index, mmap=True)
 
 # Load schema
-with open(f"indices/{index_number}/{queried_index}_schema.json", "r") as f:
-    schema = json.load(f)
+schema = indexstore.load_schema(index_number, queried_index)
+
+# Load lexical index, if the index has one
+lexical_index = indexstore.load_lexical(index_number, queried_index)
 
 
 class Evaluation:
@@ -75,7 +76,7 @@ class Evaluation:
 
             # Get facts, sources, and knn for the evaluation question
             facts_and_sources_text, knn, references = prompt_data.get_facts_and_knn(
-                eval["question"], vector_index, schema, facts
+                eval["question"], vector_index, schema, facts, lexical_index=lexical_index
             )
 
             current_date = datetime.datetime.now().strftime("%Y-%m-%d")
@@ -0,0 +1,140 @@
+"""
+A local server that speaks the parts of the OpenAI API this project uses, answering with
+providers.FakeProvider.
+
+Run it with `python fake_openai_server.py`, then set OPENAI_API_BASE in config.py to
+"http://localhost:8001/v1" to benchmark ingest or load test web.py through the real
+OpenAI client, without calling the API.
+"""
+import argparse
+import json
+import time
+import uuid
+
+from flask import Flask, Response, jsonify, request, stream_with_context
+
+import config
+from providers import FakeProvider
+
+# inputs longer than this are rejected, like the API does for text-embedding-ada-002
+MAX_INPUT_TOKENS = 8191
+
+app = Flask(__name__)
+provider = FakeProvider(config.FAKE_PROVIDER_LATENCY)
+
+
+def error(message: str, error_type: str, status: int):
+    return jsonify({"error": {"message": message, "type": error_type}}), status
+
+
+@app.route("/v1/embeddings", methods=["POST"])
+def embeddings():
+    texts = request.json["input"]
+
+    if isinstance(texts, str):
+        texts = [texts]
+
+    for text in texts:
+        # about four characters per token
+        if len(text) // 4 > MAX_INPUT_TOKENS:
+            return error(
+                f"This model's maximum context length is {MAX_INPUT_TOKENS} tokens.",
+                "invalid_request_error",
+                400,
+            )
+
+    vectors = provider.embed(texts, request.json["model"])
+
+    return jsonify(
+        {
+            "object": "list",
+            "model": request.json["model"],
+            "data": [
+                {"object": "embedding", "index": i, "embedding": vector}
+                for i, vector in enumerate(vectors)
+            ],
+            "usage": {
+                "prompt_tokens": sum(len(text) // 4 for text in texts),
+                "total_tokens": sum(len(text) // 4 for text in texts),
+            },
+        }
+    )
+
+
+def chat_completion_chunks(identifier: str):
+    created = int(time.time())
+
+    def chunk(delta: dict, finish_reason=None) -> str:
+        return "data: " + json.dumps(
+            {
+                "id": identifier,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": request.json["model"],
+                "choices": [
+                    {"index": 0, "delta": delta, "finish_reason": finish_reason}
+                ],
+            }
+        ) + "\n\n"
+
+    yield chunk({"role": "assistant"})
+
+    for text in provider.chat_stream(
+        request.json["messages"],
+        request.json["model"],
+        request.json.get("temperature"),
+    ):
+        yield chunk({"content": text})
+
+    yield chunk({}, "stop")
+    yield "data: [DONE]\n\n"
+
+
+@app.route("/v1/chat/completions", methods=["POST"])
+def chat_completions():
+    if request.json.get("stream"):
+        return Response(
+            stream_with_context(chat_completion_chunks("chatcmpl-" + uuid.uuid4().hex)),
+            mimetype="text/event-stream",
+        )
+
+    content = provider.chat(
+        request.json["messages"],
+        request.json["model"],
+        request.json.get("temperature"),
+    )
+
+    return jsonify(
+        {
+            "id": "chatcmpl-" + uuid.uuid4().hex,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.json["model"],
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": content},
+                    "finish_reason": "stop",
+                }
+            ],
+        }
+    )
+
+
+@app.route("/v1/moderations", methods=["POST"])
+def moderations():
+    return jsonify(
+        {
+            "id": "modr-" + uuid.uuid4().hex,
+            "model": "text-moderation-latest",
+            "results": [provider.moderate(request.json["input"])],
+        }
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8001)
+    args = parser.parse_args()
+
+    app.run(port=args.port, threaded=True)
@@ -0,0 +1,143 @@
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import config
+import indexstore
+
+
+class Generation:
+    """
+    The retrieval state of one index generation: its FAISS index, chunk store, lexical
+    index and the checkpoint they were loaded at.
+
+    Requests hold a generation while they search it. Once a generation is retired it
+    frees its index and chunk store as soon as the last request holding it finishes.
+    """
+
+    def __init__(self, current_index: int, stage: str = "main"):
+        self.current_index = current_index
+        self.stage = stage
+
+        # read first, so a checkpoint written while loading is picked up by the next reload
+        self.checkpoint = indexstore.read_checkpoint(current_index, stage)
+        self.vector_index = indexstore.load_index(current_index, stage, mmap=True)
+        self.schema = indexstore.load_schema(current_index, stage)
+        self.lexical = indexstore.load_lexical(current_index, stage)
+
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.retired = False
+
+    @property
+    def version(self) -> tuple:
+        """
+        Identify the content being served: the generation and the checkpoint it was loaded at.
+        """
+        return self.current_index, (self.checkpoint or {}).get("saved")
+
+    def acquire(self):
+        with self.lock:
+            self.in_flight += 1
+
+    def release(self):
+        with self.lock:
+            self.in_flight -= 1
+
+            if self.retired and self.in_flight == 0:
+                self.close()
+
+    def retire(self):
+        with self.lock:
+            self.retired = True
+
+            if self.in_flight == 0:
+                self.close()
+
+    def close(self):
+        self.vector_index = None
+        self.schema = None
+        self.lexical = None
+
+
+class LiveIndex:
+    """
+    Serve the latest published generation of an index stage, swapping to a new one without
+    interrupting requests.
+
+    A background thread polls indices/published.json, written by ingest once a generation is
+    built, and the checkpoint of the generation being served. When either changes it loads
+    the new state and swaps it in. Requests that started before the swap finish on the
+    generation they acquired.
+    """
+
+    def __init__(
+        self,
+        current_index: int,
+        stage: str = "main",
+        poll_seconds: float = config.WEB_RELOAD_POLL_SECONDS,
+    ):
+        self.stage = stage
+        self.poll_seconds = poll_seconds
+        self.lock = threading.Lock()
+
+        published = indexstore.read_published()
+        self.generation = Generation(
+            published if published is not None else current_index, stage
+        )
+
+        self.thread = threading.Thread(target=self.watch, daemon=True)
+        self.thread.start()
+
+    @contextmanager
+    def acquire(self):
+        """
+        Hold the current generation for the duration of a with block.
+        """
+        with self.lock:
+            generation = self.generation
+            generation.acquire()
+
+        try:
+            yield generation
+        finally:
+            generation.release()
+
+    def watch(self):
+        while True:
+            time.sleep(self.poll_seconds)
+
+            try:
+                self.reload_if_changed()
+            except Exception as e:
+                # e.g. a generation whose first checkpoint is still being written
+                sys.stdout.write(f"Could not reload the index: {e}\n")
+                sys.stdout.flush()
+
+    def reload_if_changed(self):
+        current = self.generation
+        published = indexstore.read_published()
+        current_index = published if published is not None else current.current_index
+
+        checkpoint = indexstore.read_checkpoint(current_index, self.stage)
+
+        if current_index == current.current_index and checkpoint == current.checkpoint:
+            return
+
+        generation = Generation(current_index, self.stage)
+
+        with self.lock:
+            self.generation = generation
+
+        current.retire()
+
+        message = f"Loaded index {current_index} with {generation.vector_index.ntotal} vectors"
+
+        checkpoint = generation.checkpoint or {}
+
+        if checkpoint.get("received"):
+            message += f"; new content searchable {time.time() - checkpoint['received'][0]:.1f}s after POST"
+
+        sys.stdout.write(message + "\n")
+        sys.stdout.flush()
@@ -0,0 +1,522 @@
+import json
+import os
+import time
+import warnings
+
+import faiss
+import numpy as np
+
+import config
+import lexical
+from chunkstore import ChunkStore
+from shardedindex import ShardedIndex
+
+
+def index_prefix(current_index: int, stage: str = "main") -> str:
+    """
+    Return the path prefix shared by all files of an index stage, e.g. indices/3/main.
+    """
+    return "indices/" + str(current_index) + "/" + stage
+
+
+class SchemaJournal:
+    """
+    Append-only schema log for an index stage, stored as JSON lines in <stage>_schema.jsonl.
+
+    Each line describes a row of the FAISS index, in order, starting from row 0 or, once
+    truncate() has dropped rows a checkpoint saved, from the row in its first line,
+    {"first_row": n}. Lines are flushed to disk with fsync every `fsync_every` documents,
+    or when sync() is called.
+    """
+
+    def __init__(self, path: str, fsync_every: int = config.SCHEMA_FSYNC_EVERY):
+        self.path = path
+        self.fsync_every = fsync_every
+        self.unsynced = 0
+
+        repair_journal(path)
+
+        self.first_row = journal_first_row(path)
+        self.file = open(path, "a")
+
+    def append(self, documents: list):
+        for document in documents:
+            self.file.write(json.dumps(document) + "\n")
+
+        self.unsynced += len(documents)
+
+        if self.unsynced >= self.fsync_every:
+            self.sync()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+
+    def truncate(self, rows: int):
+        """
+        Drop the lines of the rows before `rows`, once a checkpoint has saved them in the
+        chunk store. The journal is replaced in one step, so a crash leaves either version.
+        """
+        if rows <= self.first_row:
+            return
+
+        self.sync()
+
+        kept = read_journal(self.path, rows)
+
+        with open(self.path + ".tmp", "w") as f:
+            f.write(json.dumps({"first_row": rows}) + "\n")
+
+            for document in kept:
+                f.write(json.dumps(document) + "\n")
+
+            f.flush()
+            os.fsync(f.fileno())
+
+        self.file.close()
+        os.replace(self.path + ".tmp", self.path)
+
+        self.first_row = rows
+        self.file = open(self.path, "a")
+
+    def close(self):
+        self.sync()
+        self.file.close()
+
+
+def repair_journal(path: str):
+    """
+    Drop a partially written last line left behind by a crash mid-append.
+    """
+    if not os.path.exists(path):
+        return
+
+    with open(path, "rb+") as f:
+        contents = f.read()
+
+        if contents and not contents.endswith(b"\n"):
+            f.truncate(contents.rfind(b"\n") + 1)
+
+
+def journal_first_row(path: str) -> int:
+    """
+    Return the row described by the first line of a journal after its {"first_row": n}.
+    """
+    if not os.path.exists(path):
+        return 0
+
+    with open(path, "r") as f:
+        line = f.readline()
+
+    # chunks are journaled with their text first, so only a truncated journal starts this way
+    if line.startswith('{"first_row": ') and line.endswith("\n"):
+        return json.loads(line)["first_row"]
+
+    return 0
+
+
+def read_journal(path: str, start: int = 0) -> list:
+    """
+    Read the journal rows from row `start` onwards. Rows dropped by a truncation are in the
+    chunk store.
+    """
+    schema = []
+
+    if not os.path.exists(path):
+        return schema
+
+    first_row = row = journal_first_row(path)
+
+    with open(path, "r") as f:
+        for number, line in enumerate(f):
+            # a line without a newline was cut off by a crash
+            if not line.endswith("\n"):
+                break
+
+            if number == 0 and first_row:
+                continue
+
+            if row >= start:
+                schema.append(json.loads(line))
+
+            row += 1
+
+    return schema
+
+
+def open_chunk_store(current_index: int, stage: str = "main", writable: bool = False):
+    return ChunkStore(index_prefix(current_index, stage), writable)
+
+
+def load_schema(current_index: int, stage: str = "main"):
+    """
+    Open the chunk store of an index stage for reading.
+    """
+    prefix = index_prefix(current_index, stage)
+
+    if not os.path.exists(prefix + "_text.offsets"):
+        raise FileNotFoundError(
+            f"{prefix} has no chunk store. Run `python ingest.py` with index {current_index} as the current index to build one."
+        )
+
+    return open_chunk_store(current_index, stage)
+
+
+def lexical_directory(current_index: int, stage: str = "main") -> str:
+    return index_prefix(current_index, stage) + "_lexical"
+
+
+def load_lexical(current_index: int, stage: str = "main"):
+    """
+    Open the lexical index of an index stage, or return None if it has none.
+    """
+    directory = lexical_directory(current_index, stage)
+
+    if not os.path.exists(os.path.join(directory, "segments.json")):
+        return None
+
+    # segments in an older format are upgraded when ingest next opens the index
+    if lexical.read_manifest(directory).get("format") != lexical.FORMAT:
+        return None
+
+    return lexical.LexicalIndex(directory)
+
+
+def index_params(
+    index_type: str = config.INDEX_TYPE,
+    shards: int = config.INDEX_SHARDS,
+    shard_by: str = config.INDEX_SHARD_BY,
+    storage: str = config.INDEX_STORAGE,
+    pca_dims: int = config.INDEX_PCA_DIMS,
+) -> dict:
+    """
+    Return the FAISS factory string, search parameters and sharding for an index type.
+
+    Index types are "flat" (exact search), "ivf" (IVF-Flat), "hnsw" and "ivfpq" (IVF-PQ).
+    Chunks are split over `shards` indices by a hash of their document ("document") or of
+    their url's host ("site").
+
+    Vectors of flat, IVF and HNSW indices are stored as "float32", "float16" or "int8"
+    (scalar quantized). With pca_dims, vectors are reduced to that many dimensions by a
+    PCA trained with the index; FAISS applies it to query vectors as well.
+    """
+    codes = {"float32": "Flat", "float16": "SQfp16", "int8": "SQ8"}
+
+    if storage not in codes:
+        raise ValueError("Invalid storage type.")
+
+    if index_type == "ivfpq" and storage != "float32":
+        raise ValueError("IVF-PQ indices store PQ codes; use float32 storage.")
+
+    hnsw = f"HNSW{config.INDEX_HNSW_M}"
+
+    factories = {
+        "flat": codes[storage],
+        "ivf": f"IVF{config.INDEX_NLIST},{codes[storage]}",
+        "hnsw": hnsw if storage == "float32" else f"{hnsw},{codes[storage]}",
+        "ivfpq": f"IVF{config.INDEX_NLIST},PQ{config.INDEX_PQ_M}",
+    }
+
+    if index_type not in factories:
+        raise ValueError("Invalid index type.")
+
+    factory = factories[index_type]
+
+    if pca_dims:
+        factory = f"PCA{pca_dims},{factory}"
+
+    if shard_by not in ("document", "site"):
+        raise ValueError("Invalid shard key.")
+
+    return {
+        "type": index_type,
+        "factory": factory,
+        "nlist": config.INDEX_NLIST,
+        "nprobe": config.INDEX_NPROBE,
+        "efSearch": config.INDEX_EF_SEARCH,
+        "shards": shards,
+        "shard_by": shard_by,
+        "storage": storage,
+        "pca_dims": pca_dims,
+    }
+
+
+def create_index(params: dict, dimensions: int = 1536):
+    """
+    Create an empty index. IVF and PQ indices must be trained before vectors are added.
+
+    The index is wrapped in an IDMap2, so each vector is stored under the id of its chunk
+    store row and keeps that id when other vectors are removed.
+    """
+    if params.get("shards", 1) > 1:
+        return ShardedIndex(
+            [
+                faiss.index_factory(dimensions, "IDMap2," + params["factory"])
+                for _ in range(params["shards"])
+            ],
+            params["shard_by"],
+        )
+
+    return faiss.index_factory(dimensions, "IDMap2," + params["factory"])
+
+
+def shard_paths(current_index: int, stage: str, shards: int) -> list:
+    """
+    Return the file of each shard of an index. An index with one shard is a single file.
+    """
+    prefix = index_prefix(current_index, stage)
+
+    if shards == 1:
+        return [prefix + "_vector_index.bin"]
+
+    return [prefix + f"_vector_index.{shard}.bin" for shard in range(shards)]
+
+
+def index_ids(vector_index) -> np.ndarray:
+    """
+    Return the id of every vector in an index.
+
+    Indices created before vectors had ids number their vectors by position.
+    """
+    if isinstance(vector_index, ShardedIndex):
+        return np.concatenate(
+            [index_ids(shard) for shard in vector_index.shards] or [[]]
+        ).astype(np.int64)
+
+    if hasattr(vector_index, "id_map"):
+        return faiss.vector_to_array(vector_index.id_map)
+
+    return np.arange(vector_index.ntotal, dtype=np.int64)
+
+
+def next_id(vector_index) -> int:
+    ids = index_ids(vector_index)
+
+    return int(ids.max()) + 1 if len(ids) else 0
+
+
+def add_vectors(vector_index, vectors: np.ndarray, ids: list, documents: list):
+    """
+    Add the vectors of chunks to an index under their ids.
+
+    `documents` are the chunks themselves, which a sharded index routes by.
+    """
+    ids = np.array(ids, dtype=np.int64)
+
+    if isinstance(vector_index, ShardedIndex):
+        vector_index.add_with_ids(vectors, ids, documents)
+        return
+
+    if hasattr(vector_index, "id_map"):
+        vector_index.add_with_ids(vectors, ids)
+        return
+
+    positions = np.arange(vector_index.ntotal, vector_index.ntotal + len(ids))
+
+    if not np.array_equal(ids, positions):
+        raise ValueError(
+            f"Vectors of an index without ids must be added at {vector_index.ntotal} onwards."
+        )
+
+    vector_index.add(vectors)
+
+
+def remove_vectors(vector_index, ids: list) -> bool:
+    """
+    Remove the vectors with the given ids from an index.
+
+    Returns False if the index cannot remove vectors: HNSW indices and indices created
+    before vectors had ids. Their deleted vectors stay until the index is compacted, and
+    are hidden from search results by the chunk store's tombstones.
+    """
+    if isinstance(vector_index, ShardedIndex):
+        return all([remove_vectors(shard, ids) for shard in vector_index.shards])
+
+    if not hasattr(vector_index, "id_map"):
+        return False
+
+    try:
+        vector_index.remove_ids(np.array(ids, dtype=np.int64))
+    except RuntimeError:
+        return False
+
+    return True
+
+
+def training_minimum(params: dict) -> int:
+    """
+    Return the fewest training vectors the index type can be trained on.
+    """
+    minimum = 0
+
+    if "IVF" in params["factory"]:
+        minimum = params["nlist"]
+
+    # each PQ sub-quantizer learns 256 centroids
+    if ",PQ" in params["factory"]:
+        minimum = max(minimum, 256)
+
+    # a PCA needs at least as many vectors as output dimensions
+    if params.get("pca_dims"):
+        minimum = max(minimum, params["pca_dims"])
+
+    # int8 quantization learns the range of each dimension
+    if "SQ8" in params["factory"]:
+        minimum = max(minimum, 1)
+
+    return minimum
+
+
+def apply_search_params(vector_index, params: dict):
+    if isinstance(vector_index, ShardedIndex):
+        for shard in vector_index.shards:
+            apply_search_params(shard, params)
+
+        return
+
+    space = faiss.ParameterSpace()
+
+    if params["type"] in ("ivf", "ivfpq"):
+        space.set_index_parameter(vector_index, "nprobe", params["nprobe"])
+    elif params["type"] == "hnsw":
+        space.set_index_parameter(vector_index, "efSearch", params["efSearch"])
+
+
+def write_params(params: dict, current_index: int, stage: str = "main"):
+    with open(index_prefix(current_index, stage) + "_index_params.json", "w") as f:
+        json.dump(params, f)
+
+
+def read_params(current_index: int, stage: str = "main") -> dict:
+    """
+    Return the parameters an index was built with. Indices without a params file are flat.
+    """
+    try:
+        with open(index_prefix(current_index, stage) + "_index_params.json", "r") as f:
+            params = json.load(f)
+    except FileNotFoundError:
+        return index_params("flat", shards=1, storage="float32", pca_dims=None)
+
+    # indices from before sharding are a single index
+    params.setdefault("shards", 1)
+    params.setdefault("shard_by", "document")
+
+    return params
+
+
+def load_index(current_index: int, stage: str = "main", mmap: bool = False):
+    """
+    Load an index and set the search parameters (nprobe, efSearch) it was saved with.
+
+    With mmap=True the index is memory-mapped read-only instead of being read into memory,
+    so it loads instantly and worker processes share its pages.
+
+    An index with more than one shard is returned as a ShardedIndex.
+    """
+    io_flags = 0
+
+    if mmap:
+        io_flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+
+        # memory-maps the code arrays of flat indices (and of HNSW's storage) too
+        if hasattr(faiss, "IO_FLAG_MMAP_IFC"):
+            io_flags |= faiss.IO_FLAG_MMAP_IFC
+        else:
+            warnings.warn(
+                f"FAISS {faiss.__version__} cannot memory-map flat indices, so they are read "
+                f"into the memory of every process; FAISS {config.FAISS_MMAP_MIN_VERSION} or "
+                "newer can."
+            )
+
+    params = read_params(current_index, stage)
+
+    shards = [
+        faiss.read_index(path, io_flags)
+        for path in shard_paths(current_index, stage, params["shards"])
+    ]
+
+    if len(shards) == 1:
+        vector_index = shards[0]
+    else:
+        vector_index = ShardedIndex(shards, params["shard_by"])
+
+    apply_search_params(vector_index, params)
+
+    return vector_index
+
+
+def write_checkpoint(
+    vector_index,
+    store,
+    rows: list,
+    current_index: int,
+    stage: str = "main",
+    received: list = None,
+):
+    """
+    Atomically replace the saved FAISS index, append the rows added to it since the last
+    checkpoint to the chunk store, and record how many rows they hold.
+
+    `received` is the [oldest, newest] time at which the rows new in this checkpoint were
+    POSTed to /index, so readers can report how long content took to become searchable.
+    """
+    prefix = index_prefix(current_index, stage)
+
+    shards = getattr(vector_index, "shards", [vector_index])
+
+    # each shard is replaced on its own; ingest re-adds rows missing from any of them
+    for shard, path in zip(shards, shard_paths(current_index, stage, len(shards))):
+        faiss.write_index(shard, path + ".tmp")
+        os.replace(path + ".tmp", path)
+
+    store.append(rows)
+
+    if config.LEXICAL_INDEX:
+        lexical.update_index(lexical_directory(current_index, stage), store)
+
+    with open(prefix + "_checkpoint.json.tmp", "w") as f:
+        json.dump(
+            {"rows": vector_index.ntotal, "saved": time.time(), "received": received},
+            f,
+        )
+
+    os.replace(prefix + "_checkpoint.json.tmp", prefix + "_checkpoint.json")
+
+
+def publish(current_index: int):
+    """
+    Point web.py at an index generation, in indices/published.json.
+
+    Ingest publishes a generation once it has indexed the documents that were pending when
+    it started, so a generation built with --new is never served half-built.
+    """
+    if read_published() == current_index:
+        return
+
+    with open("indices/published.json.tmp", "w") as f:
+        json.dump({"index": current_index}, f)
+
+    os.replace("indices/published.json.tmp", "indices/published.json")
+
+
+def read_published():
+    """
+    Return the published index generation, or None if ingest never published one.
+    """
+    try:
+        with open("indices/published.json", "r") as f:
+            return json.load(f)["index"]
+    except FileNotFoundError:
+        return None
+
+
+def read_checkpoint(current_index: int, stage: str = "main") -> dict:
+    """
+    Return the metadata of the last checkpoint, or None if the stage was never checkpointed.
+    """
+    try:
+        with open(index_prefix(current_index, stage) + "_checkpoint.json", "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
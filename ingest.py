@@ -1,16 +1,34 @@
 import json
 import os
+import random
+import shutil
 import sys
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-import faiss
 import numpy as np
-import openai
 import requests
 
+import chunker
 import config
-
-openai.api_key = config.OPENAI_KEY
+import dedup
+import embeddingcache
+import indexstore
+import lexical
+import providers
+import ratelimit
+from chunkstore import ChunkStore, document_key, request_error
+from shardedindex import ShardedIndex
+
+EMBEDDING_MODEL = providers.EMBEDDING_MODEL
+
+embedding_cache = embeddingcache.EmbeddingCache(providers.EMBEDDING_CACHE_NAME)
+
+# shared by every embedding thread
+embedding_limiter = ratelimit.TokenBucket(
+    config.EMBEDDING_REQUESTS_PER_MINUTE, config.EMBEDDING_TOKENS_PER_MINUTE
+)
 
 
 def initialize_loading():
@@ -30,6 +48,10 @@ def initialize_loading():
         current_index = json.load(f)["index"]
 
     if first_start or "--new" in sys.argv:
+        # train before current.json moves on, so a failed training keeps the current index
+        params = indexstore.index_params(config.INDEX_TYPE)
+        vector_index = create_trained_index(params)
+
         if not first_start:
             current_index = current_index + 1
         
@@ -43,33 +65,160 @@ def initialize_loading():
     # read all files in logs
     # if first start or "--new" is an argument, use fresh index
 
+    prefix = indexstore.index_prefix(current_index)
+
     if first_start or "--new" in sys.argv:
-        vector_index = faiss.IndexFlatL2(1536)
-        schema = []
+        indexstore.write_params(params, current_index)
+
+        # a fresh index starts with an empty journal and chunk store
+        for path in [
+            prefix + "_schema.jsonl",
+            prefix + "_duplicates.jsonl",
+        ] + ChunkStore.files(prefix):
+            if os.path.exists(path):
+                os.remove(path)
+
+        shutil.rmtree(indexstore.lexical_directory(current_index), ignore_errors=True)
     else:
         # open most recent index, which should have the name "main.bin"
         print("Opening index "+str(current_index))
-        vector_index = faiss.read_index("indices/" + str(current_index) + "/main_vector_index.bin")
 
-        with open("indices/" + str(current_index) + "/main_schema.json", "r") as f:
-            schema = json.load(f)
+        params = indexstore.read_params(current_index)
+        paths = indexstore.shard_paths(current_index, "main", params["shards"])
+
+        if all(os.path.exists(path) for path in paths):
+            vector_index = indexstore.load_index(current_index)
+        else:
+            # ingest stopped before the first checkpoint was written; the journal has every row
+            vector_index = create_trained_index(params)
+
+        # indices created before the journal existed only have main_schema.json
+        if not os.path.exists(prefix + "_schema.jsonl") and os.path.exists(
+            prefix + "_schema.json"
+        ):
+            with open(prefix + "_schema.json", "r") as f:
+                legacy_schema = json.load(f)
+
+            legacy_journal = indexstore.SchemaJournal(prefix + "_schema.jsonl")
+            legacy_journal.append(legacy_schema)
+            legacy_journal.close()
+
+    journal = indexstore.SchemaJournal(prefix + "_schema.jsonl")
+    store = indexstore.open_chunk_store(current_index, writable=True)
+
+    # journal rows that are not in the chunk store yet: some of them were saved in the
+    # index (or in some of its shards) before ingest stopped, the rest have to be embedded again
+    tail = indexstore.read_journal(prefix + "_schema.jsonl", start=len(store))
+
+    if indexstore.next_id(vector_index) > len(store) + len(tail):
+        raise ValueError(
+            f"Index {current_index} has vectors up to id {indexstore.next_id(vector_index) - 1}, but its chunk store has "
+            f"{len(store)} rows and its journal {len(store) + len(tail)}."
+        )
+
+    if tail:
+        vector_index = replay_journal(vector_index, store, tail, current_index)
+
+    # the chunk store holds every journaled row now
+    journal.truncate(len(store))
+
+    # chunks deleted after the last checkpoint may still be in the saved index
+    if store.deleted:
+        indexstore.remove_vectors(vector_index, sorted(store.deleted))
+
+    # indices built before the lexical index existed get one for the chunks they hold
+    if config.LEXICAL_INDEX:
+        lexical.update_index(indexstore.lexical_directory(current_index), store)
+
+    return vector_index, store, journal, current_index
+
+
+def create_trained_index(params: dict):
+    """
+    Create an empty index, training it on a sample of cached embeddings if its type needs training.
+    """
+    vector_index = indexstore.create_index(params)
+
+    if vector_index.is_trained:
+        return vector_index
+
+    sample = embedding_cache.sample(config.INDEX_TRAINING_SAMPLES)
+    minimum = indexstore.training_minimum(params)
+
+    if len(sample) < minimum:
+        raise ValueError(
+            f"A {params['type']} index needs at least {minimum} cached embeddings to train on, "
+            f"but only {len(sample)} are cached. Build a flat index first to fill the cache."
+        )
 
-    return vector_index, schema, current_index
+    print(f"Training {params['factory']} index on {len(sample)} embeddings")
+    vector_index.train(sample)
+    indexstore.apply_search_params(vector_index, params)
 
+    return vector_index
 
-def exponential_backoff(embedding_text: str, max_retries: int = 5):
+
+def replay_journal(
+    vector_index,
+    store,
+    tail: list,
+    current_index: int,
+    stage: str = "main",
+):
+    """
+    Bring the index and chunk store up to date with the journal rows written after the last checkpoint.
+    """
+    present = set(indexstore.index_ids(vector_index).tolist())
+    missing_ids = [
+        len(store) + row for row in range(len(tail)) if len(store) + row not in present
+    ]
+    missing = [tail[chunk_id - len(store)] for chunk_id in missing_ids]
+
+    print(f"Replaying {len(tail)} journal rows, re-embedding {len(missing)}")
+
+    added = 0
+
+    for batch, embeddings in embed_batches(batch_documents(missing)):
+        if any(embedding is None for embedding in embeddings):
+            raise ValueError("Could not re-embed all schema rows from the journal.")
+
+        indexstore.add_vectors(
+            vector_index,
+            np.array(embeddings, dtype="float32"),
+            missing_ids[added : added + len(batch)],
+            batch,
+        )
+        added += len(batch)
+
+    indexstore.write_checkpoint(vector_index, store, tail, current_index, stage)
+
+    return vector_index
+
+
+def exponential_backoff(embedding_text, max_retries: int = 5):
     """
     Retry a request if it fails due to rate limiting.
+
+    embedding_text can be a single string or a list of strings to embed in one request.
+    Returns the embedding of each string, or None for strings the response left out.
+
+    Requests wait for room in embedding_limiter before they are sent. When the API still
+    reports a rate limit, all threads pause for an exponentially growing interval.
     """
+    if isinstance(embedding_text, str):
+        embedding_text = [embedding_text]
+
+    tokens = sum(estimate_tokens(text) for text in embedding_text)
+
     num_retries = 0
 
     while num_retries < max_retries:
+        embedding_limiter.acquire(tokens)
+
         try:
-            return openai.Embedding.create(
-                input=embedding_text, model="text-embedding-ada-002"
-            )
-        except openai.error.RateLimitError:
-            time.sleep(1 * num_retries)
+            return providers.provider.embed(embedding_text, model=EMBEDDING_MODEL)
+        except providers.RateLimitError:
+            embedding_limiter.pause(2**num_retries * random.uniform(0.5, 1.5))
             num_retries += 1
             print(f"Rate limited, retrying {num_retries} of {max_retries}...")
 
@@ -77,101 +226,782 @@ def exponential_backoff(embedding_text: str, max_retries: int = 5):
 
 
 def save_index_and_schema(
-    vector_index, schema: dict, current_index: int, stage: str = "main"
+    vector_index,
+    store,
+    rows: list,
+    journal,
+    current_index: int,
+    stage: str = "main",
+    received=None,
 ):
     """
-    Save index and schema to disk.
+    Save a checkpoint of the index, append `rows` to the chunk store and flush the schema journal to disk.
+
+    The journal is synced first, so the saved index never holds rows the journal does not,
+    and truncated once the chunk store holds its rows.
     """
     print("Saving index and schema for stage " + stage)
-    dir = "indices/" + str(current_index) + "/" + stage
-    faiss.write_index(vector_index, dir + "_vector_index.bin")
-    with open(dir + "_schema.json", "w") as f:
-        json.dump(schema, f)
+    journal.sync()
+    indexstore.write_checkpoint(
+        vector_index, store, rows, current_index, stage, received
+    )
+    journal.truncate(len(store))
+
+
+class Checkpointer:
+    """
+    Save the index every `every_chunks` new rows or every `every_seconds` seconds, whichever comes first.
+    """
+
+    def __init__(
+        self,
+        vector_index,
+        store,
+        journal,
+        current_index: int,
+        stage: str = "main",
+        every_chunks: int = config.INGEST_CHECKPOINT_CHUNKS,
+        every_seconds: int = config.INGEST_CHECKPOINT_SECONDS,
+    ):
+        self.vector_index = vector_index
+        self.store = store
+        self.journal = journal
+        self.current_index = current_index
+        self.stage = stage
+        self.every_chunks = every_chunks
+        self.every_seconds = every_seconds
+        # rows added to the index since the last checkpoint
+        self.rows = []
+        # whether chunks were deleted since the last checkpoint
+        self.deleted_chunks = False
+        self.last_saved = time.time()
+        # when the oldest and newest unsaved rows were POSTed to /index
+        self.received = None
+
+    def added(self, rows: list, received: list = []):
+        self.rows.extend(rows)
+
+        if received:
+            times = list(received) + list(self.received or [])
+            self.received = [min(times), max(times)]
+
+        if (
+            len(self.rows) >= self.every_chunks
+            or time.time() - self.last_saved >= self.every_seconds
+        ):
+            self.save()
+
+    def deleted(self):
+        self.deleted_chunks = True
+
+    def next_id(self) -> int:
+        return len(self.store) + len(self.rows)
+
+    def save(self):
+        if not self.rows and not self.deleted_chunks:
+            return
+
+        save_index_and_schema(
+            self.vector_index,
+            self.store,
+            self.rows,
+            self.journal,
+            self.current_index,
+            self.stage,
+            self.received,
+        )
+
+        if self.received:
+            print(
+                f"  Published {len(self.rows)} chunks, {time.time() - self.received[0]:.1f}s after the oldest was received"
+            )
+
+        self.rows = []
+        self.deleted_chunks = False
+        self.last_saved = time.time()
+        self.received = None
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Estimate the number of tokens in a text (~4 characters per token for English).
+    """
+    return len(text) // 4 + 1
+
+
+def batch_documents(
+    documents: list,
+    max_inputs: int = config.EMBEDDING_BATCH_SIZE,
+    max_tokens: int = config.EMBEDDING_BATCH_TOKENS,
+):
+    """
+    Group documents into batches that fit in a single embedding request.
+    """
+    batch = []
+    batch_tokens = 0
+
+    for document in documents:
+        tokens = document.get("tokens") or estimate_tokens(document["text"])
+
+        if batch and (len(batch) >= max_inputs or batch_tokens + tokens > max_tokens):
+            yield batch
+            batch = []
+            batch_tokens = 0
+
+        batch.append(document)
+        batch_tokens += tokens
+
+    if batch:
+        yield batch
+
+
+def embed_texts(texts: list, max_attempts: int = 3) -> list:
+    """
+    Embed a list of texts using as few requests as possible.
+
+    Texts found in embedding_cache are not sent to the API at all. If the API rejects a batch, it is split in half and each half is retried on its own.
+    Texts that were already embedded are never sent again. Texts that cannot be embedded
+    on their own are returned as None.
+    """
+    embeddings = embedding_cache.get_many(texts)
+    attempts = [0] * len(texts)
+
+    uncached = [p for p in range(len(texts)) if embeddings[p] is None]
+    pending = [uncached] if uncached else []
+
+    while pending:
+        positions = pending.pop()
+
+        try:
+            response = exponential_backoff([texts[p] for p in positions])
+        except providers.InvalidRequestError as e:
+            if len(positions) == 1:
+                print(f"  Could not embed chunk {positions[0]}: {e}")
+                continue
+
+            middle = len(positions) // 2
+            pending.append(positions[middle:])
+            pending.append(positions[:middle])
+            continue
+
+        for p, embedding in zip(positions, response):
+            embeddings[p] = embedding
+
+        embedding_cache.put_many(
+            [texts[p] for p in positions], [embeddings[p] for p in positions]
+        )
+
+        # retry only the inputs the API did not return an embedding for
+        missing = []
+
+        for p in positions:
+            if embeddings[p] is None:
+                attempts[p] += 1
+
+                if attempts[p] < max_attempts:
+                    missing.append(p)
+
+        if missing:
+            pending.append(missing)
+
+    return embeddings
+
+
+def embed_batches(batches, workers: int = config.INGEST_WORKERS):
+    """
+    Embed batches of documents on a pool of threads.
+
+    Yields (batch, embeddings) pairs in the order the batches were given, so rows can be
+    added to the index in the same order as the schema.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        in_flight = deque()
+
+        for batch in batches:
+            future = executor.submit(
+                embed_texts, [document["text"] for document in batch]
+            )
+            in_flight.append((batch, future))
+
+            # keep a bounded number of batches in memory ahead of the writer
+            if len(in_flight) >= workers * 2:
+                batch, future = in_flight.popleft()
+                yield batch, future.result()
+
+        while in_flight:
+            batch, future = in_flight.popleft()
+            yield batch, future.result()
+
+
+def add_embeddings(
+    vector_index, documents: list, embeddings: list, first_id: int
+) -> list:
+    """
+    Add a batch of embedded documents to the vector index, with ids from first_id on.
 
+    Documents that could not be embedded are left out. Returns the documents that were
+    added, in id order.
+    """
+    embedded = [
+        (document, embedding)
+        for document, embedding in zip(documents, embeddings)
+        if embedding is not None
+    ]
+
+    if embedded:
+        indexstore.add_vectors(
+            vector_index,
+            np.array([embedding for _, embedding in embedded], dtype="float32"),
+            range(first_id, first_id + len(embedded)),
+            [document for document, _ in embedded],
+        )
+
+    return [document for document, _ in embedded]
+
+
+def delete_chunks(vector_index, store, rows: list):
+    """
+    Delete chunks: tombstone their rows in the chunk store and remove their vectors from the
+    index, if the index type supports removing vectors.
+    """
+    store.delete(rows)
+    indexstore.remove_vectors(vector_index, rows)
+
+
+def rebuild_shards(
+    vector_index, store, shards: list, current_index: int, stage: str = "main"
+):
+    """
+    Rebuild shards of an index from the live chunks in the chunk store.
+
+    An index that is not sharded is rebuilt as a whole by rebuilding shard 0. Each shard is
+    trained again and filled from the embedding cache, so only chunks that are missing
+    from the cache are sent to the API. The other shards are left untouched.
+
+    Must be called right after a checkpoint, when every chunk in the index is in the store.
+    """
+    params = indexstore.read_params(current_index, stage)
+    sharded = isinstance(vector_index, ShardedIndex)
+    rebuilt = {shard: create_trained_index({**params, "shards": 1}) for shard in shards}
+
+    for start in range(0, len(store), 1000):
+        rows = store.live(range(start, min(start + 1000, len(store))))
+        documents = store.fetch(rows)
+
+        selected = [
+            (row, document)
+            for row, document in zip(rows, documents)
+            if not sharded or vector_index.shard_of(document) in rebuilt
+        ]
+
+        added = 0
+
+        for batch, embeddings in embed_batches(
+            batch_documents([document for _, document in selected])
+        ):
+            if any(embedding is None for embedding in embeddings):
+                raise ValueError("Could not re-embed all chunks of the index.")
+
+            vectors = np.array(embeddings, dtype="float32")
+            ids = np.array(
+                [row for row, _ in selected[added : added + len(batch)]], dtype=np.int64
+            )
+            targets = np.array(
+                [vector_index.shard_of(document) if sharded else 0 for document in batch]
+            )
+
+            for shard in np.unique(targets):
+                rebuilt[shard].add_with_ids(vectors[targets == shard], ids[targets == shard])
+
+            added += len(batch)
+
+    if sharded:
+        for shard, shard_index in rebuilt.items():
+            vector_index.shards[shard] = shard_index
+    else:
+        vector_index = rebuilt[0]
+
+    indexstore.write_checkpoint(vector_index, store, [], current_index, stage)
+
+    return vector_index
+
+
+def compact_index(vector_index, store, current_index: int, stage: str = "main"):
+    """
+    Rebuild the shards of the index that hold vectors of deleted chunks, without them.
+
+    Only needed for indices that cannot remove vectors in place (see
+    indexstore.remove_vectors); the index is returned unchanged if it holds no deleted
+    chunks.
+    """
+    shards = getattr(vector_index, "shards", [vector_index])
+    deleted = sorted(store.deleted)
+
+    dead = [
+        int(np.isin(indexstore.index_ids(shard), deleted).sum()) for shard in shards
+    ]
+
+    if not any(dead):
+        return vector_index
+
+    print(f"Compacting index {current_index}: dropping {sum(dead)} deleted chunks")
+
+    return rebuild_shards(
+        vector_index,
+        store,
+        [shard for shard in range(len(shards)) if dead[shard]],
+        current_index,
+        stage,
+    )
+
+
+def pending_files() -> list:
+    """
+    Return the files in pending_indexing/, oldest first, so later edits of a document win.
+    """
+    files = [file for file in os.listdir("pending_indexing") if file.endswith(".json")]
+
+    return sorted(
+        files, key=lambda file: (os.path.getmtime("pending_indexing/" + file), file)
+    )
 
-def get_embedding(vector_index, document: str, schema: list = []):
+
+def reject(file: str, reason: str):
     """
-    Get embedding for a document and add it to the vector index.
+    Move a pending file that cannot be indexed to rejected_docs/, where it can be fixed and
+    sent again.
     """
-    response = exponential_backoff(document["text"])
+    if not os.path.exists("rejected_docs"):
+        os.mkdir("rejected_docs")
+
+    os.rename("pending_indexing/" + file, "rejected_docs/" + file)
+
+    sys.stdout.write(f"Rejected {file}: {reason}\n")
+    sys.stdout.flush()
 
-    embeddings = response["data"][0]["embedding"]
-    vector_index.add(np.array([embeddings]).reshape(1, 1536))
 
-    schema.append(document)
-    time.sleep(1)
-    return vector_index, schema
+def requeue(file: str):
+    """
+    Index a file from indexed_docs/ again. It keeps its time, so a later version of the
+    document that is already pending still replaces it.
+    """
+    shutil.copy2("indexed_docs/" + file, "pending_indexing/" + file + ".tmp")
+    os.replace("pending_indexing/" + file + ".tmp", "pending_indexing/" + file)
 
 
 def index_pending(
     vector_index,
     current_index: int,
-    schema: list = [],
-    chunking_mechanism: str = "words",
-    word_count: int = 750,
+    store=None,
+    journal=None,
+    chunking_mechanism: str = "tokens",
+    max_tokens: int = config.CHUNK_MAX_TOKENS,
+    overlap_tokens: int = config.CHUNK_OVERLAP_TOKENS,
+    workers: int = config.INGEST_WORKERS,
+    deduplicator=None,
+    documents_map: dict = None,
+    dependents=None,
 ) -> tuple:
     """
     Index all pending documents in pending_indexing/*.json.
 
-    Chunking mechanism can be either "words" or "paragraphs".
+    Chunking mechanism can be either "tokens" or "paragraphs".
 
-    "words" will split documents into "words" word chunks.
-    "paragraphs" will split documents into paragraphs.
+    "tokens" will split documents into chunks of up to max_tokens tokens, ending on sentence
+    boundaries, with overlap_tokens tokens of overlap between consecutive chunks.
+    "paragraphs" will also start a new chunk at every paragraph, without overlap.
 
     "paragraphs" is recommended for documents where paragraphs hold a lot of context.
 
-    If key context is not available at the paragraph level of a document -- such as may the the case for a wiki page, for instance -- "words" is recommended.
+    If key context is not available at the paragraph level of a document -- such as may the the case for a wiki page, for instance -- "tokens" is recommended.
+
+    Each chunk records the character offsets of its text in the source document, which is
+    kept in indexed_docs/<source_file>.
+
+    If a deduplicator is given, chunks that duplicate an indexed chunk, or another pending
+    chunk, are dropped before they are embedded.
+
+    documents_map maps each document key (its document_id, or else its url) to the ids of
+    its chunks, as returned by ChunkStore.documents(). If it is given, a document whose key
+    is already indexed replaces the chunks indexed for it, and a pending
+    {"action": "delete", "url": ...} or {"action": "delete", "document_id": ...} request
+    deletes them. A document that shares a key with an earlier pending document is left
+    for the next round, which starts once this one is saved.
+
+    dependents (see dedup.Dependents) records the files that dropped chunks as duplicates
+    of another document's. When that document is replaced or deleted without keeping the
+    text of its chunks, they are indexed again in the next round, so their chunks are not
+    lost with it.
+
+    Files that cannot be read as a document or a deletion are moved to rejected_docs/, so
+    they do not stop the files after them from being indexed.
+
+    Batches are embedded by `workers` threads, while this function alone writes to the index,
+    the schema journal, the chunk store and indexed_docs/.
     """
     # if not exists, return
     if not os.path.exists("pending_indexing"):
-        return vector_index, schema
+        return vector_index, store
 
     if not os.path.exists("indexed_docs"):
         os.mkdir("indexed_docs")
 
-    for file in os.listdir("pending_indexing"):
-        if file.endswith(".json"):
+    # documents left for the next round wait for the earlier versions of their keys
+    while index_round(
+        vector_index,
+        current_index,
+        store,
+        journal,
+        chunking_mechanism,
+        max_tokens,
+        overlap_tokens,
+        workers,
+        deduplicator,
+        documents_map,
+        dependents,
+    ):
+        pass
+
+    return vector_index, store
+
+
+def index_round(
+    vector_index,
+    current_index: int,
+    store,
+    journal,
+    chunking_mechanism: str,
+    max_tokens: int,
+    overlap_tokens: int,
+    workers: int,
+    deduplicator,
+    documents_map: dict,
+    dependents,
+) -> bool:
+    """
+    Index the pending documents up to the first one whose key is already in this round,
+    as index_pending does. Return True if documents were left for another round, or
+    indexed documents were sent to it again.
+    """
+    checkpointer = Checkpointer(
+        vector_index, store, journal, current_index, stage="main"
+    )
+
+    documents = []
+    # when each document was written to pending_indexing/
+    received = []
+    # (file, number of documents once the file's chunks are added)
+    file_ends = []
+    dropped = 0
+    # key of each document in this round -> its file
+    keys = {}
+    # file -> key of its document, or None
+    file_keys = {}
+    # file -> rows of the chunks it replaces or deletes
+    replacing = {}
+    # file -> keys of the documents it dropped duplicate chunks of
+    owners = {}
+    deferred = False
+    requeued = False
+
+    def finish(file: str):
+        nonlocal requeued
+
+        key = file_keys.pop(file)
+
+        # the chunks a file replaces are only deleted once its own are in the journal, so
+        # a failed round leaves the earlier version searchable
+        if file in replacing:
+            replaced = replacing.pop(file)
+
+            if dependents is not None and not all(
+                deduplicator.remembers(document["text"])
+                for document in store.fetch(store.live(replaced))
+            ):
+                for dependent, dependent_key in dependents.pop(key):
+                    # an earlier version of a document in this round is replaced anyway
+                    if keys.get(dependent_key, dependent) == dependent and os.path.exists(
+                        "indexed_docs/" + dependent
+                    ):
+                        requeue(dependent)
+                        requeued = True
+
+            delete_chunks(vector_index, store, replaced)
+            checkpointer.deleted()
+
+            deleted = set(replaced)
+            rows = [row for row in documents_map.pop(key) if row not in deleted]
+
+            if rows:
+                documents_map[key] = rows
+
+            print(f"  Deleted {len(replaced)} chunks of {key}")
+
+        os.rename("pending_indexing/" + file, "indexed_docs/" + file)
+
+        if dependents is not None:
+            if key is not None and documents_map is not None:
+                dependents.discard(key)
+
+            for owner in sorted(owners.pop(file, [])):
+                dependents.add(owner, file, key)
+
+    for file in pending_files():
+        try:
             with open("pending_indexing/" + file, "r") as f:
                 data = json.load(f)
+        except ValueError as e:
+            reject(file, f"Invalid JSON: {e}")
+            continue
 
-            sys.stdout.write(f"Indexing {file}\n")
-            sys.stdout.flush()
+        error = request_error(data)
 
-            document_text = data["text"].split(" ")
+        if error is not None:
+            reject(file, error)
+            continue
 
-            # divide document into 750 word chunks, max
-            if chunking_mechanism == "words":
-                chunks = [
-                    " ".join(document_text[i : i + word_count])
-                    for i in range(0, len(document_text), word_count)
-                ]
-            elif chunking_mechanism == "paragraphs":
-                chunks = data["text"].split("\n\n")
-            else:
-                raise ValueError("Invalid chunking mechanism.")
+        key = document_key(data)
 
-            other_metadata = data.copy()
+        if documents_map is not None and key is not None:
+            # the earlier version's chunks have no ids until they are embedded
+            if key in keys:
+                deferred = True
+                break
 
-            # remove text from other_metadata
-            del other_metadata["text"]
+            keys[key] = file
 
-            fully_assembled_docs = []
+            replaced = list(documents_map.get(key, []))
 
-            for chunk in chunks:
-                fully_assembled_docs.append({"text": chunk, **other_metadata})
+            if replaced:
+                replacing[file] = replaced
 
-            print("  Indexing in "+str(len(chunks))+" chunks")
+                if deduplicator is not None:
+                    # the new version may repeat text from the chunks it replaces
+                    for document in store.fetch(store.live(replaced)):
+                        deduplicator.forget(document["text"])
 
-            for data in fully_assembled_docs:
-                vector_index, schema = get_embedding(vector_index, data, schema)
-                save_index_and_schema(vector_index, schema, current_index, stage="main")
+        file_keys[file] = key
 
-            os.rename("pending_indexing/" + file, "indexed_docs/" + file)
+        if data.get("action") == "delete":
+            file_ends.append((file, len(documents)))
+            continue
 
-    return vector_index, schema
+        received_at = os.path.getmtime("pending_indexing/" + file)
 
+        sys.stdout.write(f"Indexing {file}\n")
+        sys.stdout.flush()
 
-vector_index, schema, current_index = initialize_loading()
-vector_index, schema = index_pending(
-    vector_index, current_index, schema, chunking_mechanism="words"
-)
+        if chunking_mechanism == "tokens":
+            chunks = chunker.chunk_text(data["text"], max_tokens, overlap_tokens)
+        elif chunking_mechanism == "paragraphs":
+            chunks = chunker.chunk_text(
+                data["text"], max_tokens, 0, break_on_paragraphs=True
+            )
+        else:
+            raise ValueError("Invalid chunking mechanism.")
+
+        other_metadata = data.copy()
+
+        # remove text from other_metadata
+        del other_metadata["text"]
+
+        duplicates = 0
+
+        for chunk in chunks:
+            if deduplicator is not None:
+                position = deduplicator.duplicate(chunk["text"], key)
+
+                if position is not None:
+                    duplicates += 1
+
+                    # documents without a key are never deleted
+                    owner = deduplicator.owners[position]
+
+                    if owner is not None and owner != key:
+                        owners.setdefault(file, set()).add(owner)
+
+                    continue
+
+            documents.append(
+                {
+                    "text": chunk["text"],
+                    **other_metadata,
+                    "source_file": file,
+                    "offsets": [chunk["start"], chunk["end"]],
+                    "tokens": chunk["tokens"],
+                }
+            )
+            received.append(received_at)
+
+        print("  Indexing in "+str(len(chunks) - duplicates)+" chunks")
+
+        if duplicates:
+            print(f"  Dropped {duplicates} duplicate chunks")
+            dropped += duplicates
+
+        file_ends.append((file, len(documents)))
+
+    if dropped:
+        print(f"Dropped {dropped} duplicate chunks in total")
+
+    # chunks from several files can share a batch, so a file is only moved to
+    # indexed_docs/ once all of its chunks are in the journal
+    indexed = 0
+
+    try:
+        for batch, embeddings in embed_batches(batch_documents(documents), workers):
+            first_id = checkpointer.next_id()
+            rows = add_embeddings(vector_index, batch, embeddings, first_id)
+
+            if deduplicator is not None:
+                # chunks that could not be embedded are not duplicates if sent again
+                for document, embedding in zip(batch, embeddings):
+                    if embedding is None:
+                        deduplicator.forget(document["text"])
+
+            if documents_map is not None:
+                for chunk_id, row in enumerate(rows, first_id):
+                    if document_key(row) is not None:
+                        documents_map.setdefault(document_key(row), []).append(chunk_id)
+
+            journal.append(rows)
+            checkpointer.added(rows, received[indexed : indexed + len(batch)])
+
+            indexed += len(batch)
+
+            print(f"  Embedded {indexed} of {len(documents)} chunks")
+
+            finished = []
+
+            while file_ends and file_ends[0][1] <= indexed:
+                finished.append(file_ends.pop(0)[0])
+
+            if finished:
+                # a crash after this point is recovered by replaying the journal
+                journal.sync()
+
+            for file in finished:
+                finish(file)
+    except Exception:
+        # the rows added so far are kept, and the chunks that were not are not duplicates
+        # when the round is retried, while the chunks of earlier versions are again
+        if deduplicator is not None:
+            for document in documents[indexed:]:
+                deduplicator.forget(document["text"])
+
+            for file, replaced in replacing.items():
+                for document in store.fetch(store.live(replaced)):
+                    deduplicator.seen(document["text"], file_keys[file])
+
+        checkpointer.save()
+        raise
+
+    # nothing was left to embed
+    for file, _ in file_ends:
+        finish(file)
+
+    checkpointer.save()
+
+    return deferred or requeued
+
+
+vector_index, store, journal, current_index = initialize_loading()
+
+deduplicator = None
+dependents = None
+
+if config.DEDUP_THRESHOLD is not None:
+    deduplicator = dedup.Deduplicator.from_schema(store)
+    dependents = dedup.Dependents(
+        indexstore.index_prefix(current_index) + "_duplicates.jsonl"
+    )
+
+documents_map = store.documents()
+
+try:
+    shard = None
+
+    if "--rebuild-shard" in sys.argv:
+        shards = indexstore.read_params(current_index)["shards"]
+        position = sys.argv.index("--rebuild-shard") + 1
+        argument = sys.argv[position] if position < len(sys.argv) else ""
+
+        # checked before pending documents are indexed, so a typo fails fast
+        if not argument.isdigit() or int(argument) >= shards:
+            sys.exit(
+                f"--rebuild-shard needs a shard number from 0 to {shards - 1}: index {current_index} has {shards} shard(s)."
+            )
+
+        shard = int(argument)
+
+    vector_index, store = index_pending(
+        vector_index,
+        current_index,
+        store,
+        journal,
+        chunking_mechanism="tokens",
+        deduplicator=deduplicator,
+        documents_map=documents_map,
+        dependents=dependents,
+    )
+
+    # a new generation with nothing indexed yet has no saved index to serve
+    if indexstore.read_checkpoint(current_index) is not None:
+        indexstore.publish(current_index)
+
+    # with --compact, rebuild the index without the chunks deleted from it
+    if "--compact" in sys.argv:
+        vector_index = compact_index(vector_index, store, current_index)
+
+    # with --rebuild-shard N, rebuild shard N (or with 0, an index that is not sharded)
+    if shard is not None:
+        print(f"Rebuilding shard {shard} of index {current_index}")
+        vector_index = rebuild_shards(vector_index, store, [shard], current_index)
+
+    # with --watch, keep indexing documents as /index writes them, publishing a
+    # checkpoint after every round so web.py can pick up the new rows
+    if "--watch" in sys.argv:
+        if not os.path.exists("pending_indexing"):
+            os.mkdir("pending_indexing")
+
+        print("Watching pending_indexing/ for new documents")
+
+        last_compacted = time.time()
+        failures = 0
+
+        while True:
+            time.sleep(
+                min(
+                    config.INGEST_POLL_SECONDS * 2**failures,
+                    config.INGEST_RETRY_MAX_SECONDS,
+                )
+            )
+
+            try:
+                vector_index, store = index_pending(
+                    vector_index,
+                    current_index,
+                    store,
+                    journal,
+                    chunking_mechanism="tokens",
+                    deduplicator=deduplicator,
+                    documents_map=documents_map,
+                    dependents=dependents,
+                )
+            except (providers.ProviderError, requests.exceptions.ConnectionError) as e:
+                # the documents that were not indexed are still pending
+                failures += 1
+                print(f"Indexing failed, retrying ({failures} failures in a row): {e!r}")
+                continue
+
+            failures = 0
+
+            # a generation started with --new is published once its first checkpoint is saved
+            if indexstore.read_checkpoint(current_index) is not None:
+                indexstore.publish(current_index)
+
+            if time.time() - last_compacted >= config.INDEX_COMPACT_SECONDS:
+                vector_index = compact_index(vector_index, store, current_index)
+                last_compacted = time.time()
+finally:
+    journal.close()
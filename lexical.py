@@ -0,0 +1,414 @@
+import json
+import math
+import os
+import re
+import time
+from collections import Counter
+
+import numpy as np
+
+import config
+from chunkstore import BlobColumn, read_column
+
+TOKEN = re.compile(r"\w+")
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+# the last two segments are merged while the older one holds at most this many times the
+# rows of the newer one, which keeps the number of segments logarithmic in the rows indexed
+MERGE_RATIO = 2
+
+# version of the segment files recorded in segments.json; segments written before it was
+# recorded kept their terms in a text file read whole
+FORMAT = 2
+
+
+def tokenize(text: str) -> list:
+    return TOKEN.findall(text.lower())
+
+
+def chunk_terms(document: dict) -> list:
+    # titles are repeated in every chunk, so names in a title match all of its chunks
+    return tokenize(document.get("title", "") + " " + document["text"])
+
+
+class Segment:
+    """
+    Postings of the chunks in rows [first, end) of a chunk store, in files <path>.*:
+
+    - terms.blob and terms.offsets: the segment's terms, sorted, as a blob column (see
+      chunkstore.BlobColumn), so a term is found by binary search without reading them all.
+    - offsets.u64: the end of each term's postings.
+    - rows.i64 and frequencies.u16: the chunk row and term count of each posting.
+    - lengths.i32: the number of terms in each chunk, 0 for chunks that are not indexed.
+
+    Every file is memory-mapped, and written under a temporary name first, so readers never
+    see a partly written segment.
+    """
+
+    def __init__(self, path: str, first: int, end: int):
+        self.path = path
+        self.first = first
+        self.end = end
+
+        self.terms = BlobColumn(path + ".terms")
+        self.offsets = read_column(path + ".offsets.u64", np.uint64)
+        self.rows = read_column(path + ".rows.i64", np.int64)
+        self.frequencies = read_column(path + ".frequencies.u16", np.uint16)
+        self.lengths = read_column(path + ".lengths.i32", np.int32)
+
+    def find(self, term: str):
+        """
+        Return the position of a term in the segment's terms, or None if it has none.
+        """
+        value = term.encode("utf-8")
+        low, high = 0, len(self.terms)
+
+        while low < high:
+            middle = (low + high) // 2
+
+            if self.terms.get(middle) < value:
+                low = middle + 1
+            else:
+                high = middle
+
+        if low < len(self.terms) and self.terms.get(low) == value:
+            return low
+
+        return None
+
+    def postings(self, term: str) -> tuple:
+        i = self.find(term)
+
+        if i is None:
+            return self.rows[:0], self.frequencies[:0]
+
+        return self.postings_at(i)
+
+    def postings_at(self, i: int) -> tuple:
+        start = int(self.offsets[i - 1]) if i > 0 else 0
+        end = int(self.offsets[i])
+
+        return self.rows[start:end], self.frequencies[start:end]
+
+    @staticmethod
+    def files(path: str) -> list:
+        return [
+            path + suffix
+            for suffix in (
+                ".terms.blob",
+                ".terms.offsets",
+                ".offsets.u64",
+                ".rows.i64",
+                ".frequencies.u16",
+                ".lengths.i32",
+            )
+        ]
+
+    @staticmethod
+    def write_terms(path: str, terms: list):
+        # sorting strings orders them like their UTF-8 bytes, which find compares
+        values = [term.encode("utf-8") for term in terms]
+
+        write_file(path + ".terms.blob", b"".join(values))
+        write_file(
+            path + ".terms.offsets",
+            np.cumsum([len(value) for value in values], dtype=np.uint64).tobytes(),
+        )
+
+    @staticmethod
+    def write(path: str, postings: dict, lengths: np.ndarray):
+        """
+        Write a segment from a dict of term -> (rows, frequencies) arrays, rows ascending.
+        """
+        terms = sorted(postings)
+
+        offsets = np.cumsum([len(postings[term][0]) for term in terms], dtype=np.uint64)
+        rows = [postings[term][0] for term in terms]
+        frequencies = [postings[term][1] for term in terms]
+
+        Segment.write_terms(path, terms)
+
+        for suffix, values, dtype in (
+            (".offsets.u64", [offsets], np.uint64),
+            (".rows.i64", rows, np.int64),
+            (".frequencies.u16", frequencies, np.uint16),
+            (".lengths.i32", [lengths], np.int32),
+        ):
+            data = np.concatenate(values).astype(dtype) if values else np.zeros(0, dtype)
+
+            write_file(path + suffix, data.tobytes())
+
+
+class LexicalIndex:
+    """
+    BM25 index over the chunks of an index stage, stored next to its FAISS index.
+
+    The index is a list of segments, each covering a range of chunk rows, recorded in
+    <directory>/segments.json. Rows appended to the chunk store are indexed as a new
+    segment (see update_index), and small segments are merged into larger ones, dropping
+    deleted chunks as they go. The files of merged segments are kept for
+    LEXICAL_SEGMENT_GRACE_SECONDS, for readers that loaded segments.json before the merge.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+        with open(os.path.join(directory, "segments.json"), "r") as f:
+            manifest = json.load(f)
+
+        self.end = manifest["end"]
+        self.segments = [
+            Segment(os.path.join(directory, name), first, end)
+            for name, first, end in manifest["segments"]
+        ]
+
+        lengths = [segment.lengths[segment.lengths > 0] for segment in self.segments]
+        self.documents = sum(len(values) for values in lengths)
+        self.average_length = (
+            sum(int(values.sum()) for values in lengths) / self.documents
+            if self.documents
+            else 0
+        )
+
+    def search(self, query: str, k: int) -> list:
+        """
+        Return the rows of the k chunks with the highest BM25 score for a query, best first.
+        """
+        rows = []
+        scores = []
+
+        for term in set(tokenize(query)):
+            postings = [segment.postings(term) for segment in self.segments]
+            frequency = sum(len(term_rows) for term_rows, _ in postings)
+
+            if frequency == 0:
+                continue
+
+            idf = math.log(
+                1 + (self.documents - frequency + 0.5) / (frequency + 0.5)
+            )
+
+            for segment, (term_rows, counts) in zip(self.segments, postings):
+                if not len(term_rows):
+                    continue
+
+                lengths = segment.lengths[term_rows - segment.first]
+                counts = counts.astype(np.float32)
+
+                rows.append(term_rows)
+                scores.append(
+                    idf
+                    * counts
+                    * (K1 + 1)
+                    / (counts + K1 * (1 - B + B * lengths / self.average_length))
+                )
+
+        if not rows:
+            return []
+
+        unique, inverse = np.unique(np.concatenate(rows), return_inverse=True)
+        totals = np.bincount(inverse, weights=np.concatenate(scores))
+
+        return unique[np.argsort(-totals, kind="stable")[:k]].tolist()
+
+
+def fuse(rankings: list, k: int, constant: int = config.RRF_K) -> list:
+    """
+    Combine rankings of chunk rows with reciprocal rank fusion, returning the best k rows.
+    """
+    scores = {}
+
+    for ranking in rankings:
+        for rank, row in enumerate(ranking):
+            row = int(row)
+
+            # FAISS pads results with -1
+            if row >= 0:
+                scores[row] = scores.get(row, 0) + 1 / (constant + rank + 1)
+
+    return sorted(scores, key=lambda row: -scores[row])[:k]
+
+
+def write_file(path: str, data: bytes):
+    with open(path + ".tmp", "wb") as f:
+        f.write(data)
+
+    os.replace(path + ".tmp", path)
+
+
+def read_manifest(directory: str) -> dict:
+    path = os.path.join(directory, "segments.json")
+
+    if not os.path.exists(path):
+        return {"end": 0, "segments": [], "retired": [], "format": FORMAT}
+
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def write_manifest(directory: str, manifest: dict):
+    path = os.path.join(directory, "segments.json")
+
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f)
+
+    os.replace(path + ".tmp", path)
+
+
+def segment_name(first: int, end: int) -> str:
+    return f"{first:012d}-{end:012d}"
+
+
+def build_segment(directory: str, store, first: int, end: int) -> list:
+    """
+    Index rows [first, end) of a chunk store as a segment, leaving out deleted chunks.
+    """
+    lengths = np.zeros(end - first, dtype=np.int32)
+    postings = {}
+
+    for start in range(first, end, 1000):
+        rows = store.live(range(start, min(start + 1000, end)))
+
+        for row, document in zip(rows, store.fetch(rows)):
+            terms = chunk_terms(document)
+            lengths[row - first] = len(terms)
+
+            for term, count in Counter(terms).items():
+                postings.setdefault(term, ([], []))
+                postings[term][0].append(row)
+                postings[term][1].append(count)
+
+    name = segment_name(first, end)
+
+    Segment.write(
+        os.path.join(directory, name),
+        {
+            term: (np.array(rows, dtype=np.int64), np.array(counts, dtype=np.uint16))
+            for term, (rows, counts) in postings.items()
+        },
+        lengths,
+    )
+
+    return [name, first, end]
+
+
+def merge_segments(directory: str, segments: list, deleted: set) -> list:
+    """
+    Merge consecutive segments into one, leaving out deleted chunks.
+    """
+    first = segments[0][1]
+    end = segments[-1][2]
+
+    deleted = np.array(sorted(deleted), dtype=np.int64)
+    opened = [Segment(os.path.join(directory, name), s, e) for name, s, e in segments]
+
+    postings = {}
+
+    for segment in opened:
+        for i in range(len(segment.terms)):
+            term = segment.terms.get(i).decode("utf-8")
+            rows, counts = segment.postings_at(i)
+            keep = ~np.isin(rows, deleted)
+
+            if keep.any():
+                postings.setdefault(term, ([], []))
+                postings[term][0].append(rows[keep])
+                postings[term][1].append(counts[keep])
+
+    lengths = np.concatenate([np.array(segment.lengths) for segment in opened])
+    lengths[np.isin(np.arange(first, end), deleted)] = 0
+
+    name = segment_name(first, end)
+
+    Segment.write(
+        os.path.join(directory, name),
+        {
+            term: (np.concatenate(rows), np.concatenate(counts))
+            for term, (rows, counts) in postings.items()
+        },
+        lengths,
+    )
+
+    return [name, first, end]
+
+
+def upgrade_segments(directory: str, manifest: dict):
+    """
+    Rewrite the terms of segments written before FORMAT was recorded as blob columns. Their
+    postings are kept as they are: the terms were already sorted.
+    """
+    for name, _, _ in manifest["segments"]:
+        path = os.path.join(directory, name)
+
+        if os.path.exists(path + ".terms"):
+            with open(path + ".terms", "r", encoding="utf-8") as f:
+                terms = f.read()
+
+            Segment.write_terms(path, terms.split("\n") if terms else [])
+
+    manifest["format"] = FORMAT
+    write_manifest(directory, manifest)
+
+    for name, _, _ in manifest["segments"]:
+        if os.path.exists(os.path.join(directory, name + ".terms")):
+            os.remove(os.path.join(directory, name + ".terms"))
+
+
+def update_index(
+    directory: str,
+    store,
+    grace_seconds: float = config.LEXICAL_SEGMENT_GRACE_SECONDS,
+):
+    """
+    Index the chunks of a chunk store that are not in the lexical index yet.
+
+    Segments replaced by a merge are retired in segments.json, and their files deleted once
+    they have been retired for grace_seconds.
+    """
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    manifest = read_manifest(directory)
+
+    if manifest.get("format") != FORMAT:
+        upgrade_segments(directory, manifest)
+
+    if manifest["end"] >= len(store):
+        return
+
+    segments = manifest["segments"]
+    retired = manifest.get("retired", [])
+
+    segments.append(build_segment(directory, store, manifest["end"], len(store)))
+
+    while (
+        len(segments) >= 2
+        and segments[-2][2] - segments[-2][1]
+        <= MERGE_RATIO * (segments[-1][2] - segments[-1][1])
+    ):
+        merged = segments[-2:]
+        segments[-2:] = [merge_segments(directory, merged, store.deleted)]
+        retired.extend([name, time.time()] for name, _, _ in merged)
+
+    now = time.time()
+    expired = [name for name, since in retired if now - since >= grace_seconds]
+
+    write_manifest(
+        directory,
+        {
+            "end": len(store),
+            "segments": segments,
+            "retired": [
+                [name, since] for name, since in retired if name not in expired
+            ],
+            "format": FORMAT,
+        },
+    )
+
+    for name in expired:
+        for path in Segment.files(os.path.join(directory, name)):
+            if os.path.exists(path):
+                os.remove(path)
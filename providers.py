@@ -0,0 +1,351 @@
+import asyncio
+import hashlib
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+import aiohttp
+import numpy as np
+import openai
+
+import config
+
+EMBEDDING_MODEL = "text-embedding-ada-002"
+CHAT_MODEL = "gpt-3.5-turbo"
+
+OPENAI_API_BASE = "https://api.openai.com/v1"
+
+
+class ProviderError(Exception):
+    pass
+
+
+class RateLimitError(ProviderError):
+    """
+    The provider asked us to slow down; the request can be retried later.
+    """
+
+
+class InvalidRequestError(ProviderError):
+    """
+    The provider rejected the request itself, e.g. an input that is too long.
+    """
+
+
+class OpenAIProvider:
+    """
+    Embeddings, chat completions and moderation from the OpenAI API, or from any server
+    that speaks it (see api_base).
+    """
+
+    def __init__(self, api_key: str = config.OPENAI_KEY, api_base: str = None):
+        openai.api_key = api_key
+
+        if api_base:
+            openai.api_base = api_base
+
+        self.http = None
+
+    @contextmanager
+    def errors(self):
+        try:
+            yield
+        except openai.error.RateLimitError as e:
+            raise RateLimitError(str(e)) from e
+        except openai.error.InvalidRequestError as e:
+            raise InvalidRequestError(str(e)) from e
+        except openai.error.OpenAIError as e:
+            raise ProviderError(str(e)) from e
+
+    def call(self, function, **kwargs):
+        with self.errors():
+            return function(**kwargs)
+
+    async def acall(self, function, **kwargs):
+        # every async call shares one pool of keep-alive connections
+        if self.http is None or self.http.closed:
+            self.http = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=config.ASYNC_HTTP_CONNECTIONS)
+            )
+
+        openai.aiosession.set(self.http)
+
+        with self.errors():
+            return await function(**kwargs)
+
+    async def aclose(self):
+        if self.http is not None:
+            await self.http.close()
+            self.http = None
+
+    def cache_name(self, model: str = EMBEDDING_MODEL) -> str:
+        """
+        Return the name embeddings of model are cached under. Servers other than the OpenAI
+        API, like fake_openai_server.py, get their own name, so their embeddings are never
+        taken for OpenAI's.
+        """
+        if openai.api_base == OPENAI_API_BASE:
+            return model
+
+        return re.sub(r"[^\w.-]+", "_", openai.api_base) + "_" + model
+
+    def embed(
+        self, texts: list, model: str = EMBEDDING_MODEL, timeout: float = None
+    ) -> list:
+        """
+        Return the embedding of each text, or None for texts the response left out.
+
+        A request that takes longer than timeout seconds raises a ProviderError.
+        """
+        kwargs = {"input": texts, "model": model}
+
+        if timeout is not None:
+            kwargs["request_timeout"] = timeout
+
+        response = self.call(openai.Embedding.create, **kwargs)
+
+        return self.embeddings(texts, response)
+
+    async def aembed(self, texts: list, model: str = EMBEDDING_MODEL) -> list:
+        response = await self.acall(openai.Embedding.acreate, input=texts, model=model)
+
+        return self.embeddings(texts, response)
+
+    @staticmethod
+    def embeddings(texts: list, response) -> list:
+        embeddings = [None] * len(texts)
+
+        for item in response["data"]:
+            embeddings[item["index"]] = item["embedding"]
+
+        return embeddings
+
+    def chat(
+        self, messages: list, model: str = CHAT_MODEL, temperature: float = None
+    ) -> str:
+        kwargs = {"model": model, "messages": messages}
+
+        if temperature is not None:
+            kwargs["temperature"] = temperature
+
+        response = self.call(openai.ChatCompletion.create, **kwargs)
+
+        return response["choices"][0]["message"]["content"]
+
+    async def achat(
+        self, messages: list, model: str = CHAT_MODEL, temperature: float = None
+    ) -> str:
+        kwargs = {"model": model, "messages": messages}
+
+        if temperature is not None:
+            kwargs["temperature"] = temperature
+
+        response = await self.acall(openai.ChatCompletion.acreate, **kwargs)
+
+        return response["choices"][0]["message"]["content"]
+
+    def chat_stream(
+        self, messages: list, model: str = CHAT_MODEL, temperature: float = None
+    ):
+        """
+        Yield the text of a chat completion piece by piece, as the API generates it.
+        """
+        kwargs = {"model": model, "messages": messages, "stream": True}
+
+        if temperature is not None:
+            kwargs["temperature"] = temperature
+
+        chunks = self.call(openai.ChatCompletion.create, **kwargs)
+
+        try:
+            for chunk in chunks:
+                text = chunk["choices"][0]["delta"].get("content")
+
+                if text:
+                    yield text
+        except openai.error.OpenAIError as e:
+            raise ProviderError(str(e)) from e
+
+    async def achat_stream(
+        self, messages: list, model: str = CHAT_MODEL, temperature: float = None
+    ):
+        kwargs = {"model": model, "messages": messages, "stream": True}
+
+        if temperature is not None:
+            kwargs["temperature"] = temperature
+
+        chunks = await self.acall(openai.ChatCompletion.acreate, **kwargs)
+
+        with self.errors():
+            async for chunk in chunks:
+                text = chunk["choices"][0]["delta"].get("content")
+
+                if text:
+                    yield text
+
+    def moderate(self, text: str) -> dict:
+        """
+        Return the moderation result of a text, with a "flagged" key.
+        """
+        return self.call(openai.Moderation.create, input=text)["results"][0]
+
+    async def amoderate(self, text: str) -> dict:
+        response = await self.acall(openai.Moderation.acreate, input=text)
+
+        return response["results"][0]
+
+
+class FakeProvider:
+    """
+    Offline stand-in for a provider, to benchmark and load test without the API.
+
+    Embeddings are unit vectors seeded by a hash of the text, so the same text always has
+    the same embedding. Chat completions are canned: they cite the last link in the
+    messages, which is a source when the prompt has any. Moderation never flags anything.
+
+    Each call sleeps for a latency drawn from a lognormal distribution, given per call type
+    in `latency` as (median seconds, sigma).
+    """
+
+    def __init__(
+        self,
+        latency: dict = config.FAKE_PROVIDER_LATENCY,
+        dimensions: int = 1536,
+        seed: int = 0,
+    ):
+        self.latency = latency
+        self.dimensions = dimensions
+        self.rng = np.random.default_rng(seed)
+        self.lock = threading.Lock()
+
+    def delay(self, call: str) -> float:
+        median, sigma = self.latency.get(call, (0, 0))
+
+        if median <= 0:
+            return 0
+
+        with self.lock:
+            return median * self.rng.lognormal(0, sigma)
+
+    def wait(self, call: str):
+        time.sleep(self.delay(call))
+
+    async def await_(self, call: str):
+        await asyncio.sleep(self.delay(call))
+
+    def embedding(self, text: str) -> list:
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "big")
+        vector = np.random.default_rng(seed).standard_normal(self.dimensions)
+
+        return (vector / np.linalg.norm(vector)).astype("float32").tolist()
+
+    def cache_name(self, model: str = EMBEDDING_MODEL) -> str:
+        return "fake_" + model
+
+    def embed(
+        self, texts: list, model: str = EMBEDDING_MODEL, timeout: float = None
+    ) -> list:
+        delay = self.delay("embed")
+
+        if timeout is not None and delay > timeout:
+            time.sleep(timeout)
+            raise ProviderError("Request timed out")
+
+        time.sleep(delay)
+
+        return [self.embedding(text) for text in texts]
+
+    async def aembed(self, texts: list, model: str = EMBEDDING_MODEL) -> list:
+        await self.await_("embed")
+
+        return [self.embedding(text) for text in texts]
+
+    def chat(
+        self, messages: list, model: str = CHAT_MODEL, temperature: float = None
+    ) -> str:
+        self.wait("chat")
+
+        return self.canned(messages)
+
+    async def achat(
+        self, messages: list, model: str = CHAT_MODEL, temperature: float = None
+    ) -> str:
+        await self.await_("chat")
+
+        return self.canned(messages)
+
+    def canned(self, messages: list) -> str:
+        content = "\n".join(message["content"] for message in messages)
+        links = re.findall(r"<a href=\"(.*?)\">(.*?)</a>", content)
+
+        if links:
+            url, title = links[-1]
+
+            return f'This is a canned answer from <a href="{url}">{title}</a>.'
+
+        return "This is a canned answer."
+
+    def chat_stream(
+        self, messages: list, model: str = CHAT_MODEL, temperature: float = None
+    ):
+        """
+        Yield the canned completion word by word. The first word arrives after a fifth of
+        the chat latency, the rest are spread over the remainder.
+        """
+        duration = self.delay("chat")
+        words = re.split(r"(?<= )", self.canned(messages))
+
+        time.sleep(duration / 5)
+
+        for i, word in enumerate(words):
+            if i:
+                time.sleep(duration * 4 / 5 / len(words))
+
+            yield word
+
+    async def achat_stream(
+        self, messages: list, model: str = CHAT_MODEL, temperature: float = None
+    ):
+        duration = self.delay("chat")
+        words = re.split(r"(?<= )", self.canned(messages))
+
+        await asyncio.sleep(duration / 5)
+
+        for i, word in enumerate(words):
+            if i:
+                await asyncio.sleep(duration * 4 / 5 / len(words))
+
+            yield word
+
+    def moderate(self, text: str) -> dict:
+        self.wait("moderate")
+
+        return {"flagged": False}
+
+    async def amoderate(self, text: str) -> dict:
+        await self.await_("moderate")
+
+        return {"flagged": False}
+
+    async def aclose(self):
+        pass
+
+
+def load_provider(name: str = config.PROVIDER):
+    """
+    Return the provider named in config: "openai" or "fake".
+    """
+    if name == "openai":
+        return OpenAIProvider(api_base=config.OPENAI_API_BASE)
+
+    if name == "fake":
+        return FakeProvider()
+
+    raise ValueError("Invalid provider.")
+
+
+provider = load_provider()
+
+# what embeddings from this provider are cached under, on disk and in the query cache
+EMBEDDING_CACHE_NAME = provider.cache_name(EMBEDDING_MODEL)
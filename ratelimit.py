@@ -0,0 +1,64 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Share a requests/min and tokens/min quota between threads.
+
+    Both buckets refill continuously. acquire() blocks until there is room for one request
+    carrying the given number of tokens.
+    """
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.requests = float(requests_per_minute)
+        self.tokens = float(tokens_per_minute)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated
+        self.updated = now
+
+        self.requests = min(
+            self.requests_per_minute,
+            self.requests + elapsed * self.requests_per_minute / 60,
+        )
+        self.tokens = min(
+            self.tokens_per_minute,
+            self.tokens + elapsed * self.tokens_per_minute / 60,
+        )
+
+    def acquire(self, tokens: int = 0):
+        # a request larger than the whole bucket would otherwise wait forever
+        tokens = min(tokens, self.tokens_per_minute)
+
+        while True:
+            with self.lock:
+                self._refill()
+
+                if self.requests >= 1 and self.tokens >= tokens:
+                    self.requests -= 1
+                    self.tokens -= tokens
+                    return
+
+                wait = max(
+                    (1 - self.requests) * 60 / self.requests_per_minute,
+                    (tokens - self.tokens) * 60 / self.tokens_per_minute,
+                )
+
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        """
+        Stop every thread from sending requests for `seconds`, e.g. after the API reports a rate limit.
+        """
+        with self.lock:
+            self._refill()
+            self.requests = min(
+                self.requests, -seconds * self.requests_per_minute / 60
+            )
+            self.tokens = min(self.tokens, -seconds * self.tokens_per_minute / 60)
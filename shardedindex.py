@@ -0,0 +1,91 @@
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import faiss
+import numpy as np
+
+import config
+from chunkstore import document_key
+
+# shared by every sharded index; FAISS releases the GIL while it searches
+executor = ThreadPoolExecutor(max_workers=config.SEARCH_WORKERS)
+
+
+def shard_key(document: dict, shard_by: str = "document") -> str:
+    """
+    Return the string a chunk is routed to a shard by, so all chunks of a document, or of
+    a site with shard_by="site", land in the same shard.
+    """
+    key = document_key(document) or document.get("source_file", "")
+
+    if shard_by == "site" and document.get("url"):
+        return urlparse(document["url"]).netloc or key
+
+    return key
+
+
+class ShardedIndex:
+    """
+    A vector index split into shards, each a separate FAISS index with its own file.
+
+    Chunks are routed to shards by a hash of their document key or site (see shard_key).
+    Searches run on every shard in parallel and the results are merged into a global top k.
+    Vectors keep their chunk ids in every shard, so ids returned by search are chunk store rows.
+    """
+
+    def __init__(self, shards: list, shard_by: str = "document"):
+        self.shards = shards
+        self.shard_by = shard_by
+
+    @property
+    def ntotal(self) -> int:
+        return sum(shard.ntotal for shard in self.shards)
+
+    @property
+    def is_trained(self) -> bool:
+        return all(shard.is_trained for shard in self.shards)
+
+    def shard_of(self, document: dict) -> int:
+        key = shard_key(document, self.shard_by)
+
+        return zlib.crc32(key.encode("utf-8")) % len(self.shards)
+
+    def train(self, vectors: np.ndarray):
+        # every shard starts from the same trained, empty index
+        self.shards[0].train(vectors)
+        self.shards = [self.shards[0]] + [
+            faiss.clone_index(self.shards[0]) for _ in self.shards[1:]
+        ]
+
+    def add_with_ids(self, vectors: np.ndarray, ids: np.ndarray, documents: list):
+        shards = np.array([self.shard_of(document) for document in documents])
+
+        for shard in np.unique(shards):
+            selected = shards == shard
+            self.shards[shard].add_with_ids(vectors[selected], ids[selected])
+
+    def remove_ids(self, ids: np.ndarray) -> int:
+        return sum(shard.remove_ids(ids) for shard in self.shards)
+
+    def search(self, vectors: np.ndarray, k: int) -> tuple:
+        results = [
+            future.result()
+            for future in [
+                executor.submit(shard.search, vectors, k) for shard in self.shards
+            ]
+        ]
+
+        distances = np.hstack([D for D, _ in results])
+        ids = np.hstack([I for _, I in results])
+
+        # larger is closer for inner product, smaller for L2
+        if self.shards[0].metric_type == faiss.METRIC_INNER_PRODUCT:
+            order = np.argsort(-distances, axis=1, kind="stable")[:, :k]
+        else:
+            order = np.argsort(distances, axis=1, kind="stable")[:, :k]
+
+        return (
+            np.take_along_axis(distances, order, axis=1),
+            np.take_along_axis(ids, order, axis=1),
+        )
@@ -0,0 +1,125 @@
+import argparse
+import json
+
+import faiss
+import numpy as np
+
+import config
+import indexstore
+import providers
+from embeddingcache import EmbeddingCache
+
+# Parse command line arguments
+parser = argparse.ArgumentParser(
+    description="Compare the memory and recall@k of vector storage options on the current index."
+)
+parser.add_argument("--type", default=config.INDEX_TYPE)
+parser.add_argument("--pca-dims", type=int, default=config.INDEX_PCA_DIMS or 256)
+parser.add_argument("--queries", type=int, default=200)
+parser.add_argument("--k", type=int, default=25)
+parser.add_argument("--max-chunks", type=int, default=100000)
+args = parser.parse_args()
+
+# (storage, PCA dimensions) of each option in the report
+OPTIONS = [
+    ("float32", None),
+    ("float16", None),
+    ("int8", None),
+    ("float32", args.pca_dims),
+    ("float16", args.pca_dims),
+    ("int8", args.pca_dims),
+]
+
+with open("indices/current.json", "r") as f:
+    current_index = json.load(f)["index"]
+
+schema = indexstore.load_schema(current_index)
+embedding_cache = EmbeddingCache(providers.EMBEDDING_CACHE_NAME, writable=False)
+
+rng = np.random.default_rng(0)
+
+rows = np.array(schema.live(range(len(schema))))
+
+if len(rows) > args.max_chunks:
+    rows = np.sort(rng.choice(rows, args.max_chunks, replace=False))
+
+# the report uses the exact cached embeddings, not the vectors stored in the index
+vectors = []
+
+for start in range(0, len(rows), 1000):
+    texts = [document["text"] for document in schema.fetch(rows[start : start + 1000])]
+    vectors.extend(
+        embedding for embedding in embedding_cache.get_many(texts) if embedding is not None
+    )
+
+vectors = np.array(vectors, dtype="float32")
+
+if len(vectors) <= args.k:
+    raise ValueError(
+        f"Only {len(vectors)} chunks of index {current_index} have cached embeddings."
+    )
+
+queries = rng.choice(len(vectors), min(args.queries, len(vectors)), replace=False)
+
+
+def top_k(vector_index) -> list:
+    """
+    Return the k nearest neighbours of each query, leaving out the query itself.
+    """
+    _, I = vector_index.search(vectors[queries], args.k + 1)
+
+    return [
+        [i for i in neighbours if i != query][: args.k]
+        for query, neighbours in zip(queries, I)
+    ]
+
+
+exact_index = faiss.IndexFlatL2(vectors.shape[1])
+exact_index.add(vectors)
+exact = top_k(exact_index)
+exact_size = len(faiss.serialize_index(exact_index))
+
+training_sample = vectors[
+    rng.choice(
+        len(vectors), min(config.INDEX_TRAINING_SAMPLES, len(vectors)), replace=False
+    )
+]
+
+print(
+    f"Index {current_index}: {len(vectors)} chunks, {len(queries)} queries, {args.type} index\n"
+)
+print(f"{'storage':<22}{'bytes/vector':>14}{'total MB':>10}{'saved':>8}{f'recall@{args.k}':>12}")
+
+for storage, pca_dims in OPTIONS:
+    try:
+        params = indexstore.index_params(
+            args.type, shards=1, storage=storage, pca_dims=pca_dims
+        )
+    except ValueError:
+        continue
+
+    vector_index = faiss.index_factory(vectors.shape[1], params["factory"])
+
+    if not vector_index.is_trained:
+        vector_index.train(training_sample)
+
+    indexstore.apply_search_params(vector_index, params)
+
+    # trained parameters, like the PCA matrix, do not grow with the corpus
+    fixed_size = len(faiss.serialize_index(vector_index))
+    vector_index.add(vectors)
+
+    size = len(faiss.serialize_index(vector_index))
+
+    recall = np.mean(
+        [
+            len(set(found) & set(expected)) / args.k
+            for found, expected in zip(top_k(vector_index), exact)
+        ]
+    )
+
+    name = storage + (f", PCA{pca_dims}" if pca_dims else "")
+
+    print(
+        f"{name:<22}{(size - fixed_size) / len(vectors):>14.0f}{size / 2**20:>10.1f}{1 - size / exact_size:>8.0%}{recall:>12.3f}"
+    )
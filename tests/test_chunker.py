@@ -0,0 +1,66 @@
+import random
+
+import pytest
+
+from chunker import chunk_text, count_tokens
+
+rng = random.Random(0)
+
+WORDS = "the coffee river bank fox a dog blog post edit naïve café 東京 über".split()
+
+
+def sentence() -> str:
+    words = [rng.choice(WORDS) for _ in range(rng.randint(3, 40))]
+
+    return " ".join(words).capitalize() + rng.choice([".", "!", "?", '."'])
+
+
+def document() -> str:
+    parts = []
+
+    for _ in range(30):
+        kind = rng.random()
+
+        if kind < 0.1:
+            parts.append("\n# " + sentence() + "\n")
+        elif kind < 0.15:
+            parts.append("\n== " + sentence() + " ==\n")
+        elif kind < 0.25:
+            parts.append("\n\n")
+        elif kind < 0.3:
+            # a word longer than any chunk
+            parts.append("x" * 3000 + " ")
+        else:
+            parts.append(sentence() + " ")
+
+    return "".join(parts)
+
+
+SOURCES = [document() for _ in range(5)] + [
+    "",
+    "No sentence boundary at all " * 200,
+    "Short.",
+]
+
+
+@pytest.mark.parametrize("source", SOURCES)
+@pytest.mark.parametrize(
+    "max_tokens, overlap_tokens, break_on_paragraphs",
+    [(500, 50, False), (40, 10, False), (40, 0, True), (5, 4, False), (1, 0, False)],
+)
+def test_chunks_fit_and_point_into_the_source(
+    source, max_tokens, overlap_tokens, break_on_paragraphs
+):
+    chunks = chunk_text(source, max_tokens, overlap_tokens, break_on_paragraphs)
+
+    for chunk in chunks:
+        assert chunk["text"] == source[chunk["start"] : chunk["end"]]
+        assert count_tokens(chunk["text"]) <= chunk["tokens"] <= max_tokens
+
+    # every word of the source is in some chunk
+    covered = [False] * len(source)
+
+    for chunk in chunks:
+        covered[chunk["start"] : chunk["end"]] = [True] * (chunk["end"] - chunk["start"])
+
+    assert all(covered[i] for i, c in enumerate(source) if not c.isspace())
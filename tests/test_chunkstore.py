@@ -0,0 +1,33 @@
+import pytest
+
+from chunkstore import request_error
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        {"text": "A post.", "url": "https://example.com/post"},
+        {"text": ""},
+        {"action": "delete", "url": "https://example.com/post"},
+        {"action": "delete", "document_id": "post-1"},
+    ],
+)
+def test_valid_requests(data):
+    assert request_error(data) is None
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        None,
+        [],
+        "A post.",
+        {},
+        {"text": None},
+        {"text": ["A post."]},
+        {"action": "delete"},
+        {"action": "delete", "url": 1},
+    ],
+)
+def test_invalid_requests(data):
+    assert isinstance(request_error(data), str)
@@ -0,0 +1,84 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from coalescer import AsyncCoalescer, Coalescer
+
+
+def run_concurrently(coalescer, items: list) -> list:
+    """
+    Call coalescer(item) for each item from its own thread, all at once. Returns the result
+    or the exception of each call.
+    """
+    barrier = threading.Barrier(len(items))
+
+    def call(item):
+        barrier.wait()
+
+        try:
+            return coalescer(item)
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=len(items)) as executor:
+        return list(executor.map(call, items))
+
+
+@pytest.mark.parametrize("window_seconds, max_batch", [(0.05, 64), (0.05, 3), (0, 64)])
+def test_each_caller_gets_its_own_result(window_seconds, max_batch):
+    batches = []
+
+    def square(items):
+        batches.append(list(items))
+        return [item * item for item in items]
+
+    coalescer = Coalescer(square, window_seconds, max_batch)
+
+    assert run_concurrently(coalescer, list(range(20))) == [i * i for i in range(20)]
+
+    assert sorted(item for batch in batches for item in batch) == list(range(20))
+    assert all(len(batch) <= max_batch for batch in batches)
+
+    if window_seconds:
+        assert len(batches) < 20
+        assert coalescer.stats()["calls"] == 20
+
+
+def test_an_error_reaches_every_caller_in_the_batch():
+    def fail(items):
+        raise ValueError("provider is down")
+
+    results = run_concurrently(Coalescer(fail, 0.05, 64), list(range(10)))
+
+    assert all(isinstance(result, ValueError) for result in results)
+
+
+def test_async_coalescer():
+    batches = []
+
+    async def square(items):
+        batches.append(list(items))
+        await asyncio.sleep(0)
+        return [item * item for item in items]
+
+    async def fail(items):
+        raise ValueError("provider is down")
+
+    async def main():
+        coalescer = AsyncCoalescer(square, 0.01, 4)
+
+        assert await asyncio.gather(*[coalescer(i) for i in range(10)]) == [
+            i * i for i in range(10)
+        ]
+        assert [len(batch) for batch in batches] == [4, 4, 2]
+
+        failing = AsyncCoalescer(fail, 0.01, 64)
+        results = await asyncio.gather(
+            *[failing(i) for i in range(5)], return_exceptions=True
+        )
+
+        assert all(isinstance(result, ValueError) for result in results)
+
+    asyncio.run(main())
@@ -0,0 +1,44 @@
+from dedup import Deduplicator, Dependents
+
+TEXT = "Coffee is brewed from roasted beans, and tea is steeped from dried leaves."
+
+
+def test_duplicate_returns_the_owner_of_the_kept_chunk():
+    deduplicator = Deduplicator(threshold=0.8)
+
+    assert deduplicator.duplicate(TEXT, "a") is None
+
+    position = deduplicator.duplicate(TEXT.upper(), "b")
+
+    assert deduplicator.owners[position] == "a"
+
+    deduplicator.forget(TEXT)
+
+    assert not deduplicator.remembers(TEXT)
+    assert deduplicator.duplicate(TEXT, "b") is None
+    assert deduplicator.remembers(TEXT)
+
+
+def test_dependents_are_kept_across_restarts(tmp_path):
+    path = str(tmp_path / "main_duplicates.jsonl")
+
+    dependents = Dependents(path)
+    dependents.add("a", "b1.json", "b")
+    dependents.add("a", "c1.json", None)
+    dependents.add("d", "b1.json", "b")
+
+    # a new version of b replaces the file that dropped the duplicates
+    dependents.discard("b")
+
+    dependents = Dependents(path)
+
+    assert dependents.files == {"a": {"c1.json": None}}
+    assert dependents.pop("a") == [("c1.json", None)]
+    assert Dependents(path).pop("a") == []
+
+
+def test_dependents_skip_a_record_cut_short(tmp_path):
+    path = tmp_path / "main_duplicates.jsonl"
+    path.write_text('{"of": "a", "file": "b1.json", "key": "b"}\n{"of": "a", "fi')
+
+    assert Dependents(str(path)).pop("a") == [("b1.json", "b")]
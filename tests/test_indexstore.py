@@ -0,0 +1,36 @@
+from indexstore import SchemaJournal, read_journal
+
+
+def rows(first: int, end: int) -> list:
+    return [
+        {"text": f"chunk {row}", "url": f"https://example.com/{row}"}
+        for row in range(first, end)
+    ]
+
+
+def test_truncated_journal_keeps_row_numbers(tmp_path):
+    path = str(tmp_path / "main_schema.jsonl")
+
+    journal = SchemaJournal(path)
+    journal.append(rows(0, 10))
+    journal.truncate(6)
+    journal.append(rows(10, 12))
+    journal.close()
+
+    assert read_journal(path, 8) == rows(8, 12)
+    # rows before the truncation are in the chunk store
+    assert read_journal(path) == rows(6, 12)
+
+    journal = SchemaJournal(path)
+    journal.truncate(12)
+    journal.append(rows(12, 13))
+    journal.close()
+
+    assert read_journal(path, 12) == rows(12, 13)
+
+
+def test_journal_without_a_first_row_starts_at_row_zero(tmp_path):
+    path = tmp_path / "main_schema.jsonl"
+    path.write_text("".join(f'{{"text": "chunk {row}"}}\n' for row in range(3)) + '{"te')
+
+    assert read_journal(str(path), 1) == [{"text": "chunk 1"}, {"text": "chunk 2"}]
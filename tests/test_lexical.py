@@ -0,0 +1,150 @@
+import random
+
+import lexical
+from chunkstore import ChunkStore
+
+WORDS = "alpha beta gamma delta coffee tea python rust river bank fox dog blog post".split()
+
+QUERIES = ["coffee", "river bank", "fox dog fox", "python rust tea", "zebra", "Alpha, BETA!"]
+
+
+def documents(rng: random.Random, count: int, first: int) -> list:
+    return [
+        {
+            "text": " ".join(rng.choice(WORDS) for _ in range(rng.randint(5, 60))),
+            "title": rng.choice(WORDS).title(),
+            "url": f"https://example.com/{first + i}",
+        }
+        for i in range(count)
+    ]
+
+
+def test_incremental_index_searches_like_a_single_segment(tmp_path):
+    rng = random.Random(0)
+    store = ChunkStore(str(tmp_path / "main"), writable=True)
+
+    incremental = tmp_path / "incremental"
+
+    for size in [40, 3, 7, 1, 12, 5, 5, 30, 2, 9]:
+        store.append(documents(rng, size, len(store)))
+        lexical.update_index(str(incremental), store)
+
+    manifest = lexical.read_manifest(str(incremental))
+
+    # some segments were merged, and they still cover every row once
+    assert len(manifest["segments"]) < 10
+    assert [first for _, first, _ in manifest["segments"]] == [0] + [
+        end for _, _, end in manifest["segments"][:-1]
+    ]
+    assert manifest["end"] == len(store)
+
+    single = tmp_path / "single"
+    single.mkdir()
+    lexical.write_manifest(
+        str(single),
+        {
+            "end": len(store),
+            "segments": [lexical.build_segment(str(single), store, 0, len(store))],
+        },
+    )
+
+    incremental_index = lexical.LexicalIndex(str(incremental))
+    single_index = lexical.LexicalIndex(str(single))
+
+    assert incremental_index.documents == single_index.documents == len(store)
+    assert incremental_index.average_length == single_index.average_length
+
+    for query in QUERIES:
+        for k in [1, 5, 200]:
+            assert incremental_index.search(query, k) == single_index.search(query, k)
+
+    assert single_index.search("zebra", 5) == []
+
+
+def test_merged_segments_leave_out_deleted_chunks(tmp_path):
+    rng = random.Random(1)
+    store = ChunkStore(str(tmp_path / "main"), writable=True)
+    directory = str(tmp_path / "lexical")
+
+    store.append(documents(rng, 20, 0))
+    lexical.update_index(directory, store)
+
+    store.delete(list(range(0, 20, 2)))
+
+    # a segment at least half the size of the first merges both
+    store.append(documents(rng, 20, 20))
+    lexical.update_index(directory, store)
+
+    index = lexical.LexicalIndex(directory)
+
+    assert len(index.segments) == 1
+    assert index.documents == 30
+
+    rows = index.search(" ".join(WORDS), 100)
+
+    assert not set(rows) & store.deleted
+    assert sorted(rows) == [row for row in range(40) if row not in store.deleted]
+
+
+def test_merged_segments_are_deleted_after_the_grace_period(tmp_path):
+    rng = random.Random(2)
+    store = ChunkStore(str(tmp_path / "main"), writable=True)
+    directory = tmp_path / "lexical"
+
+    store.append(documents(rng, 10, 0))
+    lexical.update_index(str(directory), store, grace_seconds=3600)
+
+    first = lexical.read_manifest(str(directory))["segments"][0][0]
+
+    store.append(documents(rng, 10, 10))
+    lexical.update_index(str(directory), store, grace_seconds=3600)
+
+    # a reader that read the first manifest can still open the merged segment
+    manifest = lexical.read_manifest(str(directory))
+
+    assert [name for name, _ in manifest["retired"]] == [
+        first,
+        lexical.segment_name(10, 20),
+    ]
+    assert len(lexical.Segment(str(directory / first), 0, 10).terms) > 0
+
+    store.append(documents(rng, 1, 20))
+    lexical.update_index(str(directory), store, grace_seconds=0)
+
+    assert lexical.read_manifest(str(directory))["retired"] == []
+    assert not (directory / (first + ".terms.blob")).exists()
+    assert not list(directory.glob("*.tmp"))
+
+
+def test_segments_with_terms_in_a_text_file_are_upgraded(tmp_path):
+    rng = random.Random(3)
+    store = ChunkStore(str(tmp_path / "main"), writable=True)
+    directory = tmp_path / "lexical"
+
+    store.append(documents(rng, 30, 0))
+    lexical.update_index(str(directory), store)
+
+    index = lexical.LexicalIndex(str(directory))
+    expected = {query: index.search(query, 10) for query in QUERIES}
+
+    # the layout segments had before their terms were memory-mapped
+    manifest = lexical.read_manifest(str(directory))
+    del manifest["format"], manifest["retired"]
+    lexical.write_manifest(str(directory), manifest)
+
+    for name, first, end in manifest["segments"]:
+        segment = lexical.Segment(str(directory / name), first, end)
+        terms = [segment.terms.get(i).decode("utf-8") for i in range(len(segment.terms))]
+        (directory / (name + ".terms")).write_text("\n".join(terms), encoding="utf-8")
+        (directory / (name + ".terms.blob")).unlink()
+        (directory / (name + ".terms.offsets")).unlink()
+
+    lexical.update_index(str(directory), store)
+
+    assert lexical.read_manifest(str(directory))["format"] == lexical.FORMAT
+    assert not list(directory.glob("*.terms"))
+
+    index = lexical.LexicalIndex(str(directory))
+
+    for query in QUERIES:
+        assert index.search(query, 10) == expected[query]
@@ -5,24 +5,28 @@ import json
 import os
 import pprint
 import random
-import re
 import string
+import time
 import uuid
 import sys
 
-import faiss
-import openai
-from flask import (Flask, flash, jsonify, redirect, render_template, request,
-                   session)
+from flask import (Flask, Response, flash, jsonify, redirect, render_template,
+                   request, session, stream_with_context)
 from indieweb_utils import (Paginator, discover_endpoints,
                             indieauth_callback_handler)
 
 import config
-from PromptManager import Prompt
+import providers
+from answering import (REFUSAL, CitationStream, answer_cache, answered_events,
+                       build_answer, cache_answer, cached_answer, can_fall_back,
+                       clean_query, done_event, elapsed_ms, embedding_failed,
+                       live_index, prompt_data, prompt_id, query_executor,
+                       references_event, retrieve, token_events)
+from chunkstore import document_key, request_error
+from PromptManager import (async_embed_coalescer, embed_coalescer, query_cache,
+                           search_coalescer)
 
 
-openai.api_key = config.OPENAI_KEY
-
 if config.DB_TYPE == "postgres":
     import psycopg2
     conn = psycopg2.connect(
@@ -39,29 +43,19 @@ if config.DB_TYPE == "mysql":
         user=config.DB_USER,
     )
 
-prompt_data = Prompt()
-
 index_number = prompt_data.index_id
 queried_index = prompt_data.index_name
-prompt_id = prompt_data.prompt_id
 
 ME = config.ME
 CALLBACK_URL = config.CALLBACK_URL
 CLIENT_ID = config.CLIENT_ID
 API_KEY = config.API_KEY
 
-vector_index = faiss.read_index(
-    f"indices/{index_number}/{queried_index}_vector_index.bin"
-)
-
 app = Flask(__name__)
 app.secret_key = random.choice(string.ascii_letters) + "".join(
     random.choices(string.ascii_letters + string.digits, k=15)
 )
 
-with open(f"indices/{index_number}/{queried_index}_schema.json", "r") as f:
-    schema = json.load(f)
-
 # create pending_indexing dir if it doesn't exist
 if not os.path.exists("pending_indexing"):
     os.mkdir("pending_indexing")
@@ -74,15 +68,60 @@ with open("evals.json", "r") as f:
     all_evals = json.load(f)
 
 
-def prompt_is_safe(prompt: str) -> bool:
-    response = openai.Moderation.create(input=prompt)
+def write_pending(data: dict):
+    """
+    Queue a request for ingest in pending_indexing/.
+
+    It is written under a temporary name first, so `ingest.py --watch` never reads a partial file.
+    """
+    name = f"pending_indexing/{uuid.uuid4().hex}"
+
+    with open(name + ".tmp", "w") as f:
+        json.dump(data, f)
+
+    os.replace(name + ".tmp", name + ".json")
+
+
+def save_answer(response: str, query: str, username) -> str:
+    """
+    Save a response and its original question, returning the id of the answer.
+    """
+    if not config.DB_TYPE:
+        return ""
 
-    results = response["results"][0]
+    cursor = conn.cursor()
+
+    identifier = str(uuid.uuid4())
+
+    date = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    cursor.execute(
+        "INSERT INTO answers (prompt, question, id, prompt_id, date, username, status) VALUES (%s, %s, %s, %s, %s, %s, %s)",
+        (response, query, identifier, prompt_id, date, username, "0"),
+    )
+
+    conn.commit()
+
+    return identifier
+
+
+def timed(timings: dict, stage: str, function, *args):
+    """
+    Call function(*args), recording how long it took in timings[stage + "_ms"].
+    """
+    start = time.perf_counter()
+
+    try:
+        return function(*args)
+    finally:
+        timings[stage + "_ms"] = round((time.perf_counter() - start) * 1000, 1)
 
-    values = list(results.values())
 
-    # if any value is equal to True, the prompt is not safe
-    if True in values:
+def prompt_is_safe(prompt: str) -> bool:
+    results = providers.provider.moderate(prompt)
+
+    # the prompt is not safe if any category was flagged
+    if results["flagged"]:
         return False
 
     return True
@@ -130,9 +169,42 @@ def index_content():
     if key != API_KEY:
         return jsonify({"status": "error", "message": "Invalid API key."}), 401
 
-    # accepted input: any aritrary JSON object
-    with open(f"pending_indexing/{uuid.uuid4().hex}.json", "w") as f:
-        json.dump(request.json, f)
+    # accepted input: a JSON object with the document's text, and any other metadata
+    # a document with the same document_id, or else url, as an indexed one replaces it
+    data = request.json
+    error = request_error(data)
+
+    if error is not None:
+        return jsonify({"status": "error", "message": error}), 400
+
+    write_pending(data)
+
+    return jsonify({"status": "success"})
+
+
+@app.route("/index", methods=["DELETE"])
+def delete_content():
+    key = request.headers.get("Authorization", "").replace("Bearer ", "")
+
+    if key != API_KEY:
+        return jsonify({"status": "error", "message": "Invalid API key."}), 401
+
+    data = request.json or {}
+
+    if not isinstance(data, dict) or document_key(data) is None:
+        return (
+            jsonify({"status": "error", "message": "A url or document_id is required."}),
+            400,
+        )
+
+    # ingest deletes the document's chunks when it reaches this request
+    write_pending(
+        {
+            "action": "delete",
+            "document_id": data.get("document_id"),
+            "url": data.get("url"),
+        }
+    )
 
     return jsonify({"status": "success"})
 
@@ -168,7 +240,7 @@ def admin():
     return render_template(
         "admin.html",
         prompts=all_posts,
-        index_number=index_number,
+        index_number=live_index.generation.current_index,
         queried_index=queried_index,
         prompt_id=prompt_id,
         current_prompt=pprint.pformat(prompt_data.raw_prompt()),
@@ -178,6 +250,22 @@ def admin():
     )
 
 
+@app.route("/stats", methods=["GET"])
+def stats():
+    if not session.get("me") or session.get("me") != ME:
+        return redirect("/")
+
+    return jsonify(
+        {
+            "query_embedding_cache": query_cache.stats(),
+            "answer_cache": answer_cache.stats(),
+            "embedding_batches": embed_coalescer.stats(),
+            "async_embedding_batches": async_embed_coalescer.stats(),
+            "search_batches": search_coalescer.stats(),
+        }
+    )
+
+
 @app.route("/defend", methods=["POST"])
 def defend():
     """
@@ -219,9 +307,8 @@ def defend():
     Explain your response in bullet points, with reference to quotations from the sources.
     """
 
-    result = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=[
+    result = providers.provider.chat(
+        [
             {
                 "role": "system",
                 "content": """
@@ -236,85 +323,163 @@ def defend():
                 "role": "assistant",
                 "content": prompt,
             },
-        ],
-    )["choices"][0]["message"]["content"]
+        ]
+    )
 
     return jsonify(
         {"response": result + "\n\n------------------------\n\nSources:\n\n" + sources}
     )
 
 
+def prepare_query(query: str, timings: dict):
+    """
+    Moderate, embed and search a query, everything that comes before its completion.
+
+    Returns (answer, None) if the query needs no completion: it was answered before, or it
+    was flagged. Otherwise returns (None, context) with the substitutions for the prompt and
+    what the answer is built and cached from.
+    """
+    # moderation runs while the query is embedded (and searched, with
+    # RETRIEVE_DURING_MODERATION); everything is discarded if the query is flagged. It is
+    # timed on its own, so a moderation left running when the query fails does not write to
+    # timings after they are sent
+    moderation_timings = {}
+    moderation = query_executor.submit(
+        timed, moderation_timings, "moderation", prompt_is_safe, query
+    )
+
+    fallback = can_fall_back()
+
+    try:
+        embedded_query = timed(
+            timings,
+            "embedding",
+            prompt_data.embed_query,
+            query,
+            config.QUERY_EMBEDDING_TIMEOUT_SECONDS if fallback else None,
+        )
+    except providers.ProviderError as e:
+        if not fallback:
+            raise
+
+        embedding_failed(e)
+        embedded_query = None
+
+    # a question close to an earlier one is still moderated before it gets its answer
+    cached = cached_answer(embedded_query)
+
+    if cached is None and config.RETRIEVE_DURING_MODERATION:
+        context = timed(timings, "retrieval", retrieve, query, embedded_query)
+
+    # time spent waiting for moderation after everything else was done
+    safe = timed(timings, "moderation_wait", moderation.result)
+    timings.update(moderation_timings)
+
+    if not safe:
+        return REFUSAL, None
+
+    if cached is not None:
+        return cached, None
+
+    if not config.RETRIEVE_DURING_MODERATION:
+        context = timed(timings, "retrieval", retrieve, query, embedded_query)
+
+    return None, context
+
+
+def finish_answer(query: str, username, response: str, context: dict) -> dict:
+    """
+    Build the answer to a query from its completion, cache it and save it.
+    """
+    answer = build_answer(response, context)
+    cache_answer(answer, context)
+
+    return {**answer, "id": save_answer(response, query, username)}
+
+
 @app.route("/query", methods=["POST"])
 def query():
-    query = request.form["query"]
+    query = clean_query(request.form["query"])
     username = session.get("me")
 
-    # remove all punctuation aside from question marks, commas, and full stops
-    query = re.sub(r"[^\w\s\?\.,]", "", query).strip("?")  # .lower()
-
-    # query can be no more than 100 words
-    query = " ".join(query.split()[:100])
+    started = time.perf_counter()
+    timings = {}
 
-    safe = prompt_is_safe(query)
+    answer, context = prepare_query(query, timings)
 
-    if not safe:
-        return jsonify(
-            {
-                "response": "Sorry. I can't help you with that.",
-                "references": [],
-                "knn": [],
-            }
+    if answer is None:
+        response = timed(
+            timings, "completion", prompt_data.execute, context["substitutions"]
         )
+        answer = finish_answer(query, username, response, context)
+    elif answer is not REFUSAL:
+        answer = {**answer, "id": save_answer(answer["response"], query, username)}
 
-    current_date = datetime.datetime.now().strftime("%Y-%m-%d")
+    timings["total_ms"] = elapsed_ms(started)
 
-    facts = []
+    return jsonify({**answer, "timings": timings})
 
-    facts_and_sources_text, knn, references = prompt_data.get_facts_and_knn(
-        query, vector_index, schema, facts
-    )
 
-    response = prompt_data.execute(
-        {
-            "CURRENT_DATE": current_date,
-            "FACTS": "\n".join(facts),
-            "SOURCES": facts_and_sources_text,
-            "QUERY": query,
-        }
-    )
+@app.route("/query/stream", methods=["POST"])
+def query_stream():
+    """
+    Answer a query like /query, as Server-Sent Events:
+
+    - "references", with the knn and source references, before the completion starts;
+    - "token", with each piece of the response as it is generated;
+    - "citation", with each inline citation once it is complete;
+    - "done", with the id of the saved answer, all inline citations and the timings.
+    """
+    query = clean_query(request.form["query"])
+    username = session.get("me")
+
+    started = time.perf_counter()
+    timings = {}
+
+    answer, context = prepare_query(query, timings)
+
+    def answered():
+        yield from answered_events(answer)
 
-    # get all inline citations
-    citations = re.findall(r"<a href=\"(.*?)\">(.*?)</a>", response)
-
-    citations = [{"url": c[0], "title": c[1]} for c in citations]
-
-    if config.DB_TYPE:
-        cursor = conn.cursor()
-    
-        # save prompt response and original question
-        identifier = str(uuid.uuid4())
-    
-        date = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    
-        cursor.execute(
-            "INSERT INTO answers (prompt, question, id, prompt_id, date, username, status) VALUES (%s, %s, %s, %s, %s, %s, %s)",
-            (response, query, identifier, prompt_id, date, username, "0"),
-        )
-    
-        conn.commit()
-    else:
         identifier = ""
 
-    return jsonify(
-        {
-            "response": response,
-            "knn": knn,
-            "references": {
-                "inline": citations,
-                "sources": references,
-            },
-            "id": identifier,
-        }
+        if answer is not REFUSAL:
+            identifier = save_answer(answer["response"], query, username)
+
+        timings["total_ms"] = elapsed_ms(started)
+
+        yield done_event(identifier, answer, timings)
+
+    def generated():
+        yield references_event(context["knn"], context["references"])
+
+        citations = CitationStream()
+        response = []
+
+        completion_started = time.perf_counter()
+
+        for text in prompt_data.execute_stream(context["substitutions"]):
+            if not response:
+                timings["first_token_ms"] = elapsed_ms(started)
+
+            response.append(text)
+
+            yield from token_events(text, citations)
+
+        timings["completion_ms"] = elapsed_ms(completion_started)
+
+        # only written once the whole response has been sent
+        answer = finish_answer(query, username, "".join(response), context)
+
+        timings["total_ms"] = elapsed_ms(started)
+
+        yield done_event(answer["id"], answer, timings)
+
+    return Response(
+        stream_with_context(answered() if answer is not None else generated()),
+        mimetype="text/event-stream",
+        # stops proxies like nginx from buffering the stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
 
 